@@ -1,8 +1,40 @@
-import json
+import os, json
 import numpy as np
 from scipy.interpolate import interp1d
 from constants import epsilon0, echarge
 
+cs_cache = {} # reac -> (f_json mtime, prepared table)
+
+
+def clear_cache(reac=None):
+    '''Drop the cached cross-section table of reac, or all of them'''
+
+    if reac is None:
+        cs_cache.clear()
+    else:
+        cs_cache.pop(reac, None)
+
+
+def load_table(reac):
+    '''Parsed crossSections/<reac>.json with arrays and interpolators prepared once.
+Cached per reaction, re-read when the file modification time changes'''
+
+    f_json = 'crossSections/%s.json' %reac
+    mtime = os.stat(f_json).st_mtime_ns
+    if reac in cs_cache and cs_cache[reac][0] == mtime:
+        return cs_cache[reac][1]
+
+    with open(f_json, 'r') as fjson:
+        cs = json.load(fjson)
+    if 'LegCoeff' in cs.keys():
+        cs['LegCoeff'] = np.array(cs['LegCoeff'])
+        cs['LegInterp'] = interp1d(cs['En'], cs['LegCoeff'], axis=0)
+        for key in ('A', 'B', 'Ahi', 'Bhi', 'Etot_MeV', 'y'):
+            cs[key] = np.array(cs[key])
+    cs_cache[reac] = (mtime, cs)
+
+    return cs
+
 
 def sigma_diff(E_in_MeV, mu_in, reac, Z1=None, Z2=None, paired=False):
     '''General method redirecting to the relevant reaction method'''
@@ -35,11 +67,10 @@ def tabulated_sigma_diff(E_in_MeV, mu_in, reac, paired=False):
 
     from scipy.interpolate import interp2d
 
-    f_json = 'crossSections/%s.json' %reac
-    with open(f_json, 'r') as fjson:
-        cs = json.load(fjson)
-
-    f = interp2d(cs['En'], cs['mu'], cs['sigmaDiff'], kind='linear')
+    cs = load_table(reac)
+    if 'interp2d' not in cs.keys():
+        cs['interp2d'] = interp2d(cs['En'], cs['mu'], cs['sigmaDiff'], kind='linear')
+    f = cs['interp2d']
 
     E_in_MeV = np.atleast_1d(E_in_MeV)
     mu_in    = np.atleast_1d(mu_in)
@@ -61,14 +92,9 @@ def legendre_sigma_diff(E_in_MeV, mu_in, reac, paired=False):
     E_in_MeV = np.atleast_1d(E_in_MeV)
     mu_in    = np.atleast_1d(mu_in)
 
-    f_json = 'crossSections/%s.json' %reac
-    with open(f_json, 'r') as fjson:
-        cs = json.load(fjson)
-
-    cs['LegCoeff'] = np.array(cs['LegCoeff'])
+    cs = load_table(reac)
     n_leg = cs['LegCoeff'].shape[1]
-    data = interp1d(cs['En'], cs['LegCoeff'], axis=0)
-    data_E = data(E_in_MeV)
+    data_E = cs['LegInterp'](E_in_MeV)
     cs_leg = np.zeros((len(mu_in), n_leg))
     for jleg in range(n_leg):
         cs_leg[:, jleg] = eval_legendre(jleg, mu_in)
@@ -88,9 +114,7 @@ def Poly5(E_keV, poly5):
 
 def legendre_sigma_tot(E_in_MeV, reac, Emin_MeV=5.e-4):
 
-    f_json = 'crossSections/%s.json' %reac
-    with open(f_json, 'r') as fjson:
-        cs = json.load(fjson)
+    cs = load_table(reac)
 
     E_in_MeV = np.atleast_1d(E_in_MeV)
     E_keV = 1e3*E_in_MeV
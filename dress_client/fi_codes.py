@@ -1,4 +1,4 @@
-import logging
+import os, logging, warnings, hashlib
 import numpy as np
 import h5py
 from scipy.io import netcdf_file
@@ -9,36 +9,107 @@ logger.setLevel(logging.DEBUG)
 
 flt = np.float64
 
+cacheDir = os.environ.get('NEREUS_CACHE_DIR', os.path.expanduser('~/.cache/nereus'))
+readers = {} # source label -> reader class
 
+
+def register(label):
+    '''Class decorator adding a distribution reader to the registry. A reader takes its n_files input files
+(plus keyword options) and sets code_d, Rbnd, Zbnd, time'''
+
+    def add(cls):
+        readers[label] = cls
+        return cls
+    return add
+
+
+def cache_key(src, files, kwargs):
+    '''sha1 of the source label, options and path, size, mtime of each input file'''
+
+    sha = hashlib.sha1(src.encode())
+    for fname in files:
+        st = os.stat(fname)
+        sha.update(('%s|%d|%d' %(os.path.realpath(fname), st.st_size, st.st_mtime_ns)).encode())
+    sha.update(repr(sorted(kwargs.items())).encode())
+    return sha.hexdigest()
+
+
+def read_dist(src, files=(), cache=False, **kwargs):
+    '''DRESS input from the registered reader src. With cache=True (or a directory name) the converted code_d
+is stored in cacheDir ($NEREUS_CACHE_DIR, default ~/.cache/nereus) as one .npy per array and memory-mapped
+back as long as the input files are unchanged. Entries are never evicted: each input file set
+(e.g. each time slice) adds a full copy of F'''
+
+    cls = readers[src.lower()]
+    files = tuple(files)[: cls.n_files]
+    if not cache or cls.n_files == 0:
+        return cls(*files, **kwargs)
+
+    cache_dir = cache if isinstance(cache, str) else cacheDir
+    d_cache = '%s/%s_%s' %(cache_dir, src.lower(), cache_key(src.lower(), files, kwargs))
+    if os.path.isdir(d_cache):
+        logger.info('Reading cached distribution %s', d_cache)
+        dist = cls.__new__(cls)
+        dist.code_d = {}
+        for fname in os.listdir(d_cache):
+            key = fname[:-4]
+            arr = np.load('%s/%s' %(d_cache, fname), mmap_mode='r')
+            if key.startswith('d_'):
+                dist.code_d[key[2:]] = arr
+            else:
+                dist.__dict__[key] = arr
+        dist.time = float(dist.time)
+        return dist
+
+    dist = cls(*files, **kwargs)
+    arr_d = {'d_%s' %key: val for key, val in dist.code_d.items()}
+    arr_d.update(Rbnd=dist.Rbnd, Zbnd=dist.Zbnd, time=dist.time)
+    d_tmp = '%s.%d.tmp' %(d_cache, os.getpid())
+    os.makedirs(d_tmp, exist_ok=True)
+    for key, val in arr_d.items():
+        np.save('%s/%s.npy' %(d_tmp, key), val)
+    os.replace(d_tmp, d_cache)
+    logger.info('Stored cache %s', d_cache)
+    return dist
+
+
+@register('transp')
 class TRANSP2DRESS:
-    '''Reads TRANSP CDF and NUBEAM cdf output files, converting units into DRESS'''
+    '''Reads TRANSP CDF and NUBEAM cdf output files, converting units into DRESS.
+Both files are memory-mapped: only the variables used and the time slice jt are paged in,
+F stays a (cell, E, pitch) view of the NUBEAM array, so the file objects are kept open on self until close()'''
+
+    n_files = 2
 
     def __init__(self, f_plasma, f_fast):
 
         logger.info('Reading TRANSP distribution')
 
-        cv = netcdf_file(f_plasma, 'r', mmap=False).variables
-        fv = netcdf_file(f_fast, 'r', mmap=False).variables
+        self.cdf_plasma = netcdf_file(f_plasma, 'r', mmap=True)
+        self.cdf_fast   = netcdf_file(f_fast  , 'r', mmap=True)
+        cv = self.cdf_plasma.variables
+        fv = self.cdf_fast.variables
 
         spc_lbl = b''.join(fv['SPECIES_1'].data).decode()
         tfbm = fv['TIME' ].data
         tim  = cv['TIME3'].data
         jt = np.argmin(np.abs(tim - tfbm))
+        self.time = float(np.atleast_1d(tfbm)[0])
 
 # Separatrix
         self.Rbnd = 1e-2*fv['RSURF'].data[-1, :]
         self.Zbnd = 1e-2*fv['ZSURF'].data[-1, :]
 
-        rhot_cdf = cv['X'].data[jt, :]
-        rhot_fbm = fv['X2D'].data
+        rhot_cdf = np.array(cv['X'].data[jt, :])
+        rhot_fbm = np.array(fv['X2D'].data)
 
         self.code_d = {}
         self.code_d['E']        = 1.e-3*fv['E_%s' %spc_lbl].data # eV -> keV
-        self.code_d['pitch']    = fv['A_%s' %spc_lbl].data
+        self.code_d['pitch']    = np.array(fv['A_%s' %spc_lbl].data)
         self.code_d['R']        = 1e-2*fv['R2D'].data
         self.code_d['Z']        = 1e-2*fv['Z2D'].data
         self.code_d['rho']      = rhot_fbm
-        self.code_d['density']  = fv['bdens2'].data
+        self.code_d['density']  = np.array(fv['bdens2'].data)
         self.code_d['Ti']       = 1e-3*np.interp(rhot_fbm, rhot_cdf, cv['TI'].data[jt, :]) # eV -> keV
         self.code_d['nd']       =  1e6*np.interp(rhot_fbm, rhot_cdf, cv['ND'].data[jt, :]) # 1/cm**3 -> 1/m**3
         self.code_d['ang_freq'] =      np.interp(rhot_fbm, rhot_cdf, cv['OMEGA'].data[jt, :])
@@ -46,11 +117,45 @@ class TRANSP2DRESS:
         self.code_d['F']        = np.transpose(fv['F_%s' %spc_lbl].data, axes=(0, 2, 1)) # -> cell, E, pitch; no need to normalise
 
 
+    def close(self):
+        '''Close both files. Views into the maps (code_d['F']) stay valid, as the maps are released
+only with the last view, so netcdf_file's warning about them is silenced here'''
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', message='Cannot close a netcdf_file opened with mmap=True', category=RuntimeWarning)
+            for cdf in (getattr(self, 'cdf_plasma', None), getattr(self, 'cdf_fast', None)):
+                if cdf is not None:
+                    cdf.close()
+
+
+    def __del__(self):
+
+        self.close()
+
+
+def read_rzPitchE(dset, species=0, itime=0, max_block_mb=256.):
+    '''Read one species and time of an ASCOT rzPitchEdist ordinate (species, time, energy, pitch, z, R, charge)
+directly into the DRESS layout (R*z, energy, pitch), pitch reversed. Hyperslabs of a few R columns at a time
+keep the temporary memory below max_block_mb'''
+
+    nE, nmu, nz, nR = dset.shape[2: 6]
+    F = np.empty((nR, nz, nE, nmu), dtype=dset.dtype)
+    col_mb = nE*nmu*nz*dset.dtype.itemsize/1024.**2
+    n_blk = max(1, min(nR, int(max_block_mb/col_mb)))
+    for jR in range(0, nR, n_blk):
+        blk = dset[species, itime, :, :, :, jR: jR + n_blk, 0] # energy, pitch, z, R
+        F[jR: jR + n_blk] = np.transpose(blk, axes=(3, 2, 0, 1))[..., ::-1] # h5py has no negative steps
+    return F.reshape(nR*nz, nE, nmu)
+
+
+@register('ascot')
 class ASCOT2DRESS:
     '''Reads ASCOT HDF5 output file, converting units into DRESS'''
 
+    n_files = 1
+
 
-    def __init__(self, f_fast):
+    def __init__(self, f_fast, rotation=False, species=0, itime=0):
 
         logger.info('Reading ASCOT distribution')
 
@@ -62,7 +167,7 @@ class ASCOT2DRESS:
         pl1d       = f['plasma/1d']
         bfield     = f['bfield']
         dist_grids = f['distributions/rzPitchEdist/abscissae']
-        fbm_h5     = f['distributions/rzPitchEdist/ordinate'][:] # species, time, energy, pitch, z, R, ?
+        F = read_rzPitchE(f['distributions/rzPitchEdist/ordinate'], species=species, itime=itime) # no need to normalise
 
         rhop_pl  = pl1d['rho'][:]
         ti = 1.e-3*pl1d['ti' ][:]    # eV -> keV
@@ -88,6 +193,8 @@ class ASCOT2DRESS:
 
         f.close()
 
+        self.time = float(grid['time'][itime]) if 'time' in grid.keys() else 0.
+
 # R, z rectangular domain
         Rmin = grid_b['R'][0]
         Rmax = grid_b['R'][-1]
@@ -97,9 +204,9 @@ class ASCOT2DRESS:
         self.Zbnd = [Zmin, Zmin, Zmax, Zmax]
 
 # Fast ion distribution and grids
-        fbm = fbm_h5[0, 0, :, ::-1, :, :, 0] # energy, pitch, z, R; no need to normalise
-        nE, nmu, nz, nR = fbm.shape
-        nRz = nR*nz
+        nRz, nE, nmu = F.shape
+        nR = len(grid['R'])
+        nz = len(grid['z'])
         dR  = (Rmax - Rmin)/float(nR)
         dz  = (Zmax - Zmin)/float(nz)
         dE  = (grid_b['energy'][-1] - grid_b['energy'][0])/float(nE)
@@ -112,7 +219,7 @@ class ASCOT2DRESS:
         self.code_d['E'] = grid['energy']*6.242e+15 # J -> keV
         self.code_d['pitch'] = grid['pitch']
         self.code_d['dV'] = 2.*np.pi*self.code_d['R']*dR*dz
-        self.code_d['F'] = np.transpose(fbm, axes=(3, 2, 0, 1)).reshape(nRz, nE, nmu)  # Rz, energy, pitch
+        self.code_d['F'] = F # Rz, energy, pitch
 
 # 2D grid for rho_pol
         psi_sep = 0
@@ -125,25 +232,59 @@ class ASCOT2DRESS:
 # Integrate distribution over E, pitch
         self.code_d['density'] = np.sum(self.code_d['F'], axis=(1, 2))*dE*dmu
 
-# Interpolate Ti, nd, v_rot to (unrolled) 2D grid
-        self.code_d['Ti']    = np.zeros(nRz, dtype=flt)
-        self.code_d['nd']    = np.zeros(nRz, dtype=flt)
+# Interpolate Ti, nd, v_rot to (unrolled) 2D grid; NaN outside the separatrix
+        rho = self.code_d['rho']
+        outside = np.isnan(rho) | (rho > 1.)
+        xrho = np.where(outside, 0., rho)
+        self.code_d['Ti']    = np.where(outside, np.nan, np.interp(xrho, rhop_pl, ti))
+        self.code_d['nd']    = np.where(outside, np.nan, np.interp(xrho, rhop_pl, nD))
         self.code_d['v_rot'] = np.zeros((nRz, 3), dtype=flt)
-        nrho_pl = len(rhop_pl)
-        for jR in range(nR):
-            for jz in range(nz):
-                xrho = self.code_d['rho'][jR + jz*nR]
-                if np.isnan(xrho) or xrho > 1.: # outside separatrix
-                    self.code_d['Ti'][jR + jz*nR] = np.nan
-                    self.code_d['nd'][jR + jz*nR] = np.nan
-                else:
-                    jrho = np.argmin(np.abs(rhop_pl - xrho))
-                    if jrho == 0:
-                        ind = [jrho, jrho + 1]
-                    elif jrho == nrho_pl-1:
-                        ind = [jrho-1, jrho]
-                    else:
-                        ind  = [jrho-1, jrho, jrho+1]
-                    self.code_d['Ti'   ][jR + jz*nR] = np.interp(xrho, rhop_pl[ind], ti[ind])
-                    self.code_d['nd'   ][jR + jz*nR] = np.interp(xrho, rhop_pl[ind], nD[ind])
-#                    self.code_d['v_rot'][jR, jz, 1] = np.interp(xrho, rhop_pl[ind], vt[ind]) # Too high in repo case
+        if rotation: # off by default: too high in repo case
+            self.code_d['v_rot'][:, 1] = np.where(outside, 0., np.interp(xrho, rhop_pl, vt))
+
+
+@register('analytic')
+class ANALYTIC2DRESS:
+    '''Analytic test source: elliptic plasma with parabolic profiles and an isotropic slowing-down fast-ion distribution'''
+
+    n_files = 0
+
+
+    def __init__(self, R0=1.65, a=0.5, kappa=1.6, Ti0=5., nd0=5e19, nfast0=5e18, E_inj=60., nR=40, nz=64, nE=30, nmu=20):
+
+        logger.info('Analytic distribution')
+
+        self.time = 0.
+        theta = np.linspace(0., 2.*np.pi, 101)
+        self.Rbnd = R0 + a*np.cos(theta)
+        self.Zbnd = kappa*a*np.sin(theta)
+
+# Cells inside the separatrix, 1st index is R
+        R_b = np.linspace(R0 - a, R0 + a, nR + 1)
+        z_b = np.linspace(-kappa*a, kappa*a, nz + 1)
+        E_b = np.linspace(0., 1.2*E_inj, nE + 1)
+        mu_b = np.linspace(-1., 1., nmu + 1)
+        Rmesh, Zmesh = np.meshgrid(0.5*(R_b[1:] + R_b[:-1]), 0.5*(z_b[1:] + z_b[:-1]), indexing='ij')
+        rho = np.hypot((Rmesh - R0)/a, Zmesh/(kappa*a)).ravel()
+        inside = rho < 1.
+        rho = rho[inside]
+
+        self.code_d = {}
+        self.code_d['E']        = 0.5*(E_b[1:] + E_b[:-1]) # keV
+        self.code_d['pitch']    = 0.5*(mu_b[1:] + mu_b[:-1])
+        self.code_d['R']        = Rmesh.ravel()[inside]
+        self.code_d['Z']        = Zmesh.ravel()[inside]
+        self.code_d['rho']      = rho
+        self.code_d['dV']       = 2.*np.pi*self.code_d['R']*(R_b[1] - R_b[0])*(z_b[1] - z_b[0])
+        self.code_d['Ti']       = Ti0*(1. - 0.9*rho**2)
+        self.code_d['nd']       = nd0*(1. - 0.8*rho**2)
+        self.code_d['ang_freq'] = np.zeros_like(rho)
+        self.code_d['density']  = nfast0*(1. - rho**2)**2
+
+# Slowing-down energy spectrum, critical energy ~ 15*Te, Te = Ti
+        E = self.code_d['E']
+        E_crit = 15.*Ti0
+        shape = np.where(E <= E_inj, 1./(E**1.5 + E_crit**1.5), 0.)
+        shape /= np.sum(shape)*(E_b[1] - E_b[0])*(mu_b[1] - mu_b[0])*nmu
+        self.code_d['F'] = self.code_d['density'][:, None, None]*np.repeat(shape[:, None], nmu, axis=1)[None, :, :] # cell, E, pitch
+
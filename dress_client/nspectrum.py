@@ -1,12 +1,18 @@
 import os, logging
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import h5py
 import matplotlib.pyplot as plt
 from matplotlib.path import Path
 import matplotlib.patches as patches
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool, cpu_count, shared_memory
+from scipy.sparse import csr_matrix, csc_matrix
+from scipy.spatial import cKDTree, Delaunay
 import dress
 import response
+from reactivities import react, brysk_bins
 from dress_client import fi_codes
+from los.los import read_los
 
 fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
 hnd = logging.StreamHandler()
@@ -19,87 +25,483 @@ flt = np.float64
 
 
 def calcvols(tuple_in):
+    '''DRESS spectrum summed over the volumes; with a (n_chan, n_vols) weight matrix chan_wgt, one spectrum per channel'''
 
-    vols, dist1, dist2, scalc, En_bins = tuple_in
-    nes = dress.utils.calc_vols(vols, dist1, dist2, scalc, En_bins, integrate=True, quiet=True)
+    vols, dist1, dist2, scalc, En_bins, chan_wgt, quiet = tuple_in
+    if chan_wgt is None:
+        return dress.utils.calc_vols(vols, dist1, dist2, scalc, En_bins, integrate=True, quiet=quiet)
+    nes = dress.utils.calc_vols(vols, dist1, dist2, scalc, En_bins, integrate=False, quiet=quiet)
 
-    return nes
+    return chan_wgt @ np.asarray(nes)
+
+
+shared_keys = ('dV', 'solidAngle', 'R', 'Z', 'density', 'F', 'nd', 'Ti', 'v_rot')
+reac_dists = {'bt': ('fast', 'bulk'), 'th': ('bulk', 'bulk'), 'bb': ('fast', 'fast')}
+worker_d = {} # per-process DRESS input, set by init_worker
+
+
+def share_arrays(arr_d):
+    '''Copy arrays into shared memory blocks, once; strided views (e.g. the transposed, memory-mapped F)
+are copied directly, without a contiguous temporary. Returns the blocks (to be unlinked by the owner)
+and the {key: (name, shape, dtype)} descriptors passed to init_worker'''
+
+    shm_l = []
+    spec  = {}
+    for key, arr in arr_d.items():
+        arr = np.asarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        shm_l.append(shm)
+        spec[key] = (shm.name, arr.shape, arr.dtype.str)
+    return shm_l, spec
+
+
+def init_worker(spec, const_d):
+    '''Pool initializer: attach the shared arrays described in spec (plain ndarrays are taken as they are,
+for the serial path) and store the small constant inputs E, pitch, En_bins, chan_wgt, Bdir'''
+
+    worker_d.clear()
+    worker_d['shm'] = []
+    for key, val in spec.items():
+        if isinstance(val, np.ndarray):
+            worker_d[key] = val
+        else:
+            name, shape, dtype = val
+            shm = shared_memory.SharedMemory(name=name)
+            worker_d['shm'].append(shm)
+            worker_d[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    worker_d.update(const_d)
+    worker_d['scalc'] = {}
+
+
+def make_dists(inp, idx, Bdir, kinds=('fast', 'bulk')):
+    '''DRESS volume and distribution objects (only those in kinds) for the cells idx'''
+
+    Nvols = len(idx)
+    B_dir = np.repeat(Bdir, Nvols, axis=0)
+    vols = dress.utils.make_vols(inp['dV'][idx], inp['solidAngle'][idx], pos=(inp['R'][idx], inp['Z'][idx]))
+    dist_d = {}
+    if 'fast' in kinds:
+        dist_d['fast'] = dress.utils.make_dist('energy-pitch', 'd', Nvols, inp['density'][idx],
+            energy_axis=inp['E'], pitch_axis=inp['pitch'], distvals=inp['F'][idx], ref_dir=B_dir)
+    if 'bulk' in kinds:
+        dist_d['bulk'] = dress.utils.make_dist('maxwellian', 'd', Nvols, inp['nd'][idx], temperature=inp['Ti'][idx], v_collective=inp['v_rot'][idx])
+    return vols, dist_d
+
+
+def coarsen_axis(F, x, axis, tol):
+    '''Halve the uniform grid x along axis by pairwise merges of neighbouring bins, as long as
+the relative L1 change of F stays below tol; non-uniform grids are left unchanged.
+Returns F, x and the relative L1 change'''
+
+    norm = np.sum(np.abs(F))
+    err = 0.
+    dx = np.diff(x)
+    if len(dx) > 0 and not np.allclose(dx, dx[0], rtol=1e-6, atol=0.):
+        logger.info('Non-uniform grid, no coarsening along axis %d', axis)
+        return F, x, err
+    while F.shape[axis] > 2 and F.shape[axis] % 2 == 0 and norm > 0:
+        Fa = np.take(F, np.arange(0, F.shape[axis], 2), axis=axis)
+        Fb = np.take(F, np.arange(1, F.shape[axis], 2), axis=axis)
+        d_err = np.sum(np.abs(Fa - Fb))/norm # merged bins move by |a - b|/2 each
+        if err + d_err > tol:
+            break
+        err += d_err
+        F = 0.5*(Fa + Fb)
+        x = 0.5*(x[::2] + x[1::2])
+    return F, x, err
+
+
+def calcchunk(task):
+    '''Worker: component reac on the cells idx with n_samples MC samples per cell, from the worker_d input.
+Returned with its label, as results arrive unordered'''
+
+    reac, idx, n_samples = task
+    if n_samples not in worker_d['scalc']:
+        worker_d['scalc'][n_samples] = dress.SpectrumCalculator(dress.reactions.DDNHe3Reaction(), n_samples=n_samples)
+    dist1, dist2 = reac_dists[reac]
+    vols, dist_d = make_dists(worker_d, idx, worker_d['Bdir'], kinds=(dist1, dist2))
+    chan_wgt = None if worker_d['chan_wgt'] is None else worker_d['chan_wgt'][:, idx]
+    nes = calcvols((vols, dist_d[dist1], dist_d[dist2], worker_d['scalc'][n_samples], worker_d['En_bins'], chan_wgt, worker_d['quiet']))
+    return reac, nes
+
+
+class TH_TABLE:
+    '''Bin-integrated Brysk thermonuclear spectra on a (Ti, v_proj) grid, log-spaced in Ti and uniform in v_proj,
+with bilinear interpolation; Ti and v_proj are clipped to the grid'''
+
+
+    def __init__(self, En_bins, reac_lbl='D(D,n)3He', Ti_lim=(0.2, 100.), v_max=5e5, nT=200, nv=101):
+
+        self.logT = np.linspace(np.log(Ti_lim[0]), np.log(Ti_lim[1]), nT)
+        self.v = np.linspace(-v_max, v_max, nv)
+        T2, v2 = np.meshgrid(np.exp(self.logT), self.v, indexing='ij')
+        self.table = brysk_bins(np.asarray(En_bins, dtype=flt), T2.ravel(), reac_lbl=reac_lbl, v_proj=v2.ravel()).reshape(nT, nv, -1)
+
+
+    def weights(self, Ti_keV, v_proj=0.):
+        '''Sparse (n_cells, nT*nv) bilinear interpolation weights on the table nodes'''
+
+        Ti_keV, v_proj = np.broadcast_arrays(np.atleast_1d(Ti_keV), v_proj)
+        nT, nv = self.table.shape[:2]
+        xT = np.interp(np.log(Ti_keV), self.logT, np.arange(nT))
+        xv = np.interp(v_proj, self.v, np.arange(nv))
+        jT = np.minimum(xT.astype(np.int32), nT - 2)
+        jv = np.minimum(xv.astype(np.int32), nv - 2)
+        wT = xT - jT
+        wv = xv - jv
+        n_cells = len(xT)
+        rows = np.tile(np.arange(n_cells), 4)
+        cols = np.concatenate((jT*nv + jv, jT*nv + jv + 1, (jT + 1)*nv + jv, (jT + 1)*nv + jv + 1))
+        wgt  = np.concatenate(((1. - wT)*(1. - wv), (1. - wT)*wv, wT*(1. - wv), wT*wv))
+        return csr_matrix((wgt, (rows, cols)), shape=(n_cells, nT*nv))
+
+
+    def __call__(self, Ti_keV, v_proj=0.):
+        '''Spectra (n_cells, n_bins), each summing to 1 within the energy range'''
+
+        return self.weights(Ti_keV, v_proj) @ self.table.reshape(-1, self.table.shape[2])
+
+
+th_tables = {} # (En_bins, reac_lbl) -> TH_TABLE
+
+
+def channel_weights(los_index, n_chan):
+    '''Sparse one-hot (n_chan, n_vols) matrix summing the volumes of each LoS channel'''
+
+    if los_index is None:
+        return None
+    n_vols = len(los_index)
+    return csr_matrix((np.ones(n_vols), (los_index, np.arange(n_vols))), shape=(n_chan, n_vols))
+
+
+def read_code(src, f_in1, f_in2, cache=False, reader_kw=None):
+    '''Fast-ion code output converted into DRESS input, by the reader registered in fi_codes for src;
+reader_kw: reader options, e.g. {'species': 1, 'itime': 2} for ASCOT'''
+
+    reader_kw = {} if reader_kw is None else reader_kw
+    return fi_codes.read_dist(src, (f_in1, f_in2), cache=cache, **reader_kw)
+
+
+def read_resp(f_resp):
+    '''Response matrix from a CDF or HEPRO file'''
+
+    resp = response.RESP()
+    fname, ext = os.path.splitext(f_resp)
+    if ext.lower() == '.cdf':
+        resp.from_cdf(f_resp)
+    else:
+        resp.from_hepro(f_resp)
+    return resp
 
 
 class nSpectrum:
 
 
-    def __init__(self, f_in1, f_in2, f_los=None, src='transp', samples_per_volume_element=1e4):
+    def __init__(self, f_in1, f_in2, f_los=None, src='transp', samples_per_volume_element=1e4, los_interp='nearest', aggregate=True, cache=False, cell_tol=0., grid_tol=0., reader_kw=None):
+
+        self.set_options(f_los, src, samples_per_volume_element, los_interp, aggregate, cache, cell_tol, grid_tol, reader_kw)
+        self.codeClass = read_code(src, f_in1, f_in2, cache=cache, reader_kw=self.reader_kw)
+        self.set_input()
+
+
+    def set_options(self, f_los, src, samples_per_volume_element, los_interp, aggregate, cache, cell_tol, grid_tol, reader_kw=None):
+        '''Settings shared by all distributions: code and reader options, MC samples, LoS mapping, cache, compression'''
 
         self.samples_per_volume_element = samples_per_volume_element
         self.code = src
+        self.reader_kw = {} if reader_kw is None else dict(reader_kw)
+        self.cache = cache
+        self.compress_tol = (cell_tol, grid_tol)
+        self.los_interp = los_interp
+        self.los_aggregate = aggregate
+        self.los_d = None if f_los is None else read_los(f_los)
+
+
+    def set_input(self):
+        '''DRESS input from self.codeClass, mapped onto the LoS volumes if a LoS file is set'''
 
-        if src == 'transp':
-            self.codeClass = fi_codes.TRANSP2DRESS(f_in1, f_in2)
-        elif src == 'ascot':
-            self.codeClass = fi_codes.ASCOT2DRESS(f_in1)
+        self.los_index = None
+        self.n_chan = 1
+        self.chan_wgt = None
+        self.n_fast = None
 
-        if f_los is None:
+        if self.los_d is None:
             self.los = False
             self.dressInput = self.codeClass.code_d
             self.dressInput['solidAngle'] = 4*np.pi*np.ones_like(self.dressInput['dV'])
         else:
             self.los = True
-            x_m, y_m, z_m, omega, V_m3 = np.loadtxt(f_los, unpack=True)
-            R_m = np.hypot(x_m, y_m)
-            self.los_dressInput(R_m, z_m)
-            self.dressInput['R']  = R_m[self.inside]
-            self.dressInput['Z']  = z_m[self.inside]
-            self.dressInput['dV'] = V_m3[self.inside]
-            self.dressInput['solidAngle'] = omega[self.inside]
-
-
-    def los_dressInput(self, R_m, z_m):
-        '''Mapping quantities from original volumes to LoS volumes. Removing LoS volumes outside a {R, z} domain (separatrix or 2D cartesian grid)'''
+            los_d = self.los_d
+            R_m = np.hypot(los_d['x'], los_d['y'])
+            z_m = los_d['z']
+            aggregate = self.los_aggregate and self.los_interp == 'nearest'
+            self.los_dressInput(R_m, z_m, interp=self.los_interp, map_input=not aggregate)
+            if 'los_index' in los_d.keys(): # multi-LoS file, one spectrum per channel
+                self.los_index = np.asarray(los_d['los_index'][self.inside], dtype=np.int32)
+                self.n_chan = int(np.max(los_d['los_index'])) + 1
+            if aggregate:
+                self.aggregate(R_m[self.inside], z_m[self.inside], los_d['vol'][self.inside], los_d['omega'][self.inside])
+            else:
+                self.dressInput['R']  = R_m[self.inside]
+                self.dressInput['Z']  = z_m[self.inside]
+                self.dressInput['dV'] = los_d['vol'][self.inside]
+                self.dressInput['solidAngle'] = los_d['omega'][self.inside]
+                self.chan_wgt = channel_weights(self.los_index, self.n_chan)
+        if max(self.compress_tol) > 0:
+            self.compress(*self.compress_tol)
+
+
+    def los_dressInput(self, R_m, z_m, interp='nearest', map_input=True):
+        '''Mapping quantities from original volumes to LoS volumes. Removing LoS volumes outside a {R, z} domain (separatrix or 2D cartesian grid).
+interp='nearest': nearest distribution cell (KD-tree); 'linear': barycentric interpolation on the Delaunay triangulation of the cells.
+map_input=False only sets the LoS -> distribution index los2fbm.
+The mapping is kept as long as the distribution grid and the separatrix do not change (e.g. time slices)'''
 
         n_los = len(R_m)
+        code_d = self.codeClass.code_d
+        sepPolygon = np.hstack((self.codeClass.Rbnd, self.codeClass.Zbnd)).reshape(2, len(self.codeClass.Rbnd)).T
+        grid_pts = np.column_stack((code_d['R'], code_d['Z']))
+        RZ_points = np.hstack((R_m, z_m)).reshape(2, n_los).T
 
+        reuse = hasattr(self, 'map_key') and np.array_equal(self.map_key[0], grid_pts) \
+            and np.array_equal(self.map_key[1], sepPolygon) and self.map_key[2] == n_los
+        if reuse:
+            logger.debug('Reusing LoS mapping')
+        else:
 # LoS volumes inside R, z domain
+            self.sepPath = Path(sepPolygon)
+            self.inside = self.sepPath.contains_points(RZ_points)
+            logger.debug('Volumes inside Sep %d out of %d', np.sum(self.inside), n_los)
+            self.kdtree = cKDTree(grid_pts)
+            self.los2fbm = self.kdtree.query(RZ_points[self.inside])[1]
+            self.map_key = (grid_pts, sepPolygon, n_los)
+            self.map_bary = None
+        los_pts = RZ_points[self.inside]
+        los_sep = self.los2fbm
 
-        RZ_points = np.hstack((R_m, z_m)).reshape(2, n_los).T
-        sepPolygon = np.hstack((self.codeClass.Rbnd, self.codeClass.Zbnd)).reshape(2, len(self.codeClass.Rbnd)).T
-        self.sepPath = Path(sepPolygon)
-        self.inside = self.sepPath.contains_points(RZ_points)
-        logger.debug('Volumes inside Sep %d out of %d', np.sum(self.inside), n_los)
-
-        los2fbm = np.zeros(n_los, dtype=np.int32)
-        for jlos in range(n_los):
-            if self.inside[jlos]:
-                d2 = (self.codeClass.code_d['R'] - R_m[jlos])**2 + (self.codeClass.code_d['Z'] - z_m[jlos])**2
-                los2fbm[jlos] = np.argmin(d2)
-        los_sep = los2fbm[self.inside]
+        self.dressInput = {}
+        if not map_input:
+            return
+        if interp == 'linear':
+            if self.map_bary is None:
+                tri = Delaunay(grid_pts)
+                simplex = tri.find_simplex(los_pts)
+                ok = simplex >= 0
+                trans = tri.transform[simplex]
+                bary2 = np.einsum('ijk,ik->ij', trans[:, :2], los_pts - trans[:, 2])
+                bary = np.where(ok[:, None], np.column_stack((bary2, 1. - np.sum(bary2, axis=1))), [1., 0., 0.])
+                vert = np.where(ok[:, None], tri.simplices[simplex], los_sep[:, None]) # outside the hull: nearest
+                logger.debug('Barycentric mapping, %d LoS volumes outside the triangulation', np.sum(~ok))
+                self.map_bary = (bary, vert)
+            bary, vert = self.map_bary
+            for key, val in code_d.items():
+                if key in ('E', 'pitch'):
+                    self.dressInput[key] = val
+                else:
+                    self.dressInput[key] = np.einsum('ij,ij...->i...', bary, val[vert])
+        else:
+            for key, val in code_d.items():
+                if key in ('E', 'pitch'):
+                     self.dressInput[key] = val
+                else: # map variables onto LoS volumes
+                    self.dressInput[key] = val[los_sep]
+
+
+    def aggregate(self, R_los, z_los, dV, solidAngle):
+        '''Merge the LoS volumes mapped onto the same distribution cell (and LoS channel):
+DRESS runs once per unique cell, with dV and solidAngle such that sum(dV*solidAngle) is conserved
+and {R, Z} at the emission-weighted centroid. Channel spectra are recovered with the weight fractions in self.chan_wgt'''
+
+        code_d = self.codeClass.code_d
+        ucell, jcell = np.unique(self.los2fbm, return_inverse=True)
+        n_cells = len(ucell)
+        chan = np.zeros(len(dV), dtype=np.int32) if self.los_index is None else self.los_index
+        wgt = csr_matrix((dV*solidAngle, (chan, jcell)), shape=(self.n_chan, n_cells)) # sums duplicates
+        wgt_tot = np.asarray(wgt.sum(axis=0)).ravel()
+        wgt_tot[wgt_tot <= 0] = np.finfo(flt).tiny
 
         self.dressInput = {}
-        for key, val in self.codeClass.code_d.items():
+        for key, val in code_d.items():
             if key in ('E', 'pitch'):
-                 self.dressInput[key] = val
-            else: # map variables onto LoS volumes
-                self.dressInput[key] = val[los_sep]
-
-
-    def run(self, parallel=True):
-        '''Execute DRESS calculation, computing Neutron Emission Spectra: beam-target, thermonuclear, beam-beam'''
+                self.dressInput[key] = val
+            else:
+                self.dressInput[key] = val[ucell]
+        self.dressInput['R']  = np.bincount(jcell, weights=dV*solidAngle*R_los, minlength=n_cells)/wgt_tot
+        self.dressInput['Z']  = np.bincount(jcell, weights=dV*solidAngle*z_los, minlength=n_cells)/wgt_tot
+        self.dressInput['dV'] = np.bincount(jcell, weights=dV, minlength=n_cells)
+        self.dressInput['solidAngle'] = wgt_tot/self.dressInput['dV']
+        if self.los_index is not None:
+            self.chan_wgt = csr_matrix(wgt.multiply(1./wgt_tot[None, :]))
+        logger.info('Aggregated %d LoS volumes into %d distribution cells', len(dV), n_cells)
+
+
+    def compress(self, cell_tol=1e-3, grid_tol=1e-2):
+        '''Reduce the fast-ion phase space before DRESS.
+Cells are reordered so that the first n_fast ones carry all but a fraction cell_tol of the
+beam-target (density*nd*dV*omega) and beam-beam (density^2*dV*omega) emission proxies:
+bt, bb run on these only, th on all cells, and F is kept for the first n_fast cells only.
+The E, pitch grids are halved while the relative L1 change of F stays below grid_tol.
+The error estimates on the bt, bb rates are stored in self.compress_err'''
+
+        inp = dict(self.dressInput) # code_d itself without LoS
+        wgt = inp['dV']*inp['solidAngle']
+        dens = np.nan_to_num(inp['density'])
+        proxy = {'bt': dens*np.nan_to_num(inp['nd'])*wgt, 'bb': dens**2*wgt}
+        keep = np.zeros(len(wgt), dtype=bool)
+        self.compress_err = {}
+        for reac, prx in proxy.items():
+            order = np.argsort(prx)[::-1]
+            tail = np.sum(prx) - np.cumsum(prx[order]) # dropped, keeping order[: j+1]
+            n_keep = min(len(prx), np.searchsorted(-tail, -cell_tol*np.sum(prx)) + 1)
+            keep[order[: n_keep]] = True
+        for reac, prx in proxy.items():
+            self.compress_err[reac] = np.sum(prx[~keep])/max(np.sum(prx), np.finfo(flt).tiny)
+        order = np.concatenate((np.where(keep)[0], np.where(~keep)[0]))
+        self.n_fast = int(np.sum(keep))
+
+        for key, val in inp.items():
+            if key not in ('E', 'pitch', 'F'):
+                inp[key] = val[order]
+        F = inp['F'][order[: self.n_fast]]
+        F, inp['E']    , err_E  = coarsen_axis(F, inp['E']    , 1, 0.5*grid_tol)
+        F, inp['pitch'], err_mu = coarsen_axis(F, inp['pitch'], 2, 0.5*grid_tol)
+        inp['F'] = F
+        self.dressInput = inp
+        if self.chan_wgt is not None:
+            self.chan_wgt = csr_matrix(csc_matrix(self.chan_wgt)[:, order])
+        self.compress_err['grid'] = err_E + err_mu
+        for reac in ('bt', 'bb'):
+            self.compress_err[reac] += self.compress_err['grid']
+        logger.info('Compression: %d of %d cells for bt, bb; F grid %d x %d', self.n_fast, len(wgt), len(inp['E']), len(inp['pitch']))
+        logger.info('Relative rate error estimate: bt %8.2e, bb %8.2e (cells + grid, grid %8.2e)', self.compress_err['bt'], self.compress_err['bb'], self.compress_err['grid'])
+
+
+    def th_analytic(self, En_bins, n_dir=8):
+        '''Noise-free thermonuclear spectrum: per cell rate nd^2*<sigma v>*dV*omega/(4 pi) (the factor 0.5
+for identical reactants is applied in run) times the tabulated Brysk spectrum. The cells carry no emission
+direction, so the Doppler shift is averaged over isotropic directions: v_proj uniform in [-|v_rot|, |v_rot|],
+Gauss-Legendre with n_dir nodes. Cells below the Bosch-Hale range (Ti < 0.2 keV) do not emit'''
+
+        key = (En_bins.tobytes(), 'D(D,n)3He')
+        if key not in th_tables:
+            th_tables[key] = TH_TABLE(En_bins)
+        table = th_tables[key]
+
+        inp = self.dressInput
+        Ti = np.nan_to_num(inp['Ti'])
+        nd = np.nan_to_num(inp['nd'])
+        rate = nd**2*1e-6*react(np.clip(Ti, 0.2, 100.), 'D(D,n)3He')*inp['dV']*inp['solidAngle']/(4.*np.pi) # cm**3 -> m**3
+        rate[Ti < 0.2] = 0.
+        v_abs = np.linalg.norm(inp['v_rot'], axis=1)
+        x_gl, w_gl = np.polynomial.legendre.leggauss(n_dir)
+# The spectra are linear in the node weights: sum the cells onto the table nodes first
+        wgt = sum([0.5*w*table.weights(np.maximum(Ti, 0.2), x*v_abs) for x, w in zip(x_gl, w_gl)])
+        wgt = csr_matrix(wgt.multiply(rate[:, None]))
+        if self.chan_wgt is None:
+            node_wgt = np.asarray(wgt.sum(axis=0)).ravel()
+        else:
+            node_wgt = (self.chan_wgt @ wgt).toarray()
+        return node_wgt @ table.table.reshape(-1, table.table.shape[2])
+
+
+    def cell_cost(self):
+        '''Relative Monte Carlo cost per cell and component: cells without fast ions are cheap for bt, bb;
+sampling the fast distribution gets more expensive with the number of populated (E, pitch) bins'''
+
+        F = self.dressInput['F'] # first n_fast cells after compress
+        fill = np.count_nonzero(F.reshape(len(F), -1), axis=1)/float(F[0].size)
+        fast = np.where(self.dressInput['density'][: len(F)] > 0, 1. + fill, 0.1)
+        bulk = np.where(self.dressInput['nd'] > 0, 1., 0.1)
+        return {'bt': fast, 'th': bulk, 'bb': 2.*fast}
+
+
+    def cell_emission(self):
+        '''Cheap per-cell estimate of each component's contribution, density x reactivity x dV x omega.
+The D(D,n) reactivity is taken at Ti (th), Ti + <E_fast>/3 (bt) and 2<E_fast>/3 (bb), within the Bosch-Hale range'''
+
+        inp = self.dressInput
+        F = inp['F'] # first n_fast cells after compress
+        n_fast = len(F)
+        wgt = inp['dV']*inp['solidAngle']
+        nd = np.nan_to_num(inp['nd'])
+        Ti = np.nan_to_num(inp['Ti'])
+        F_E = np.sum(F, axis=2)
+        E_mean = F_E @ inp['E']/np.maximum(np.sum(F_E, axis=1), np.finfo(flt).tiny)
+        dens = np.nan_to_num(inp['density'][: n_fast])
+        sigv = lambda T_keV: react(np.clip(T_keV, 0.2, 100.), 'D(D,n)3He')
+        emis = {}
+        emis['bt'] = dens*nd[: n_fast]*sigv(Ti[: n_fast] + E_mean/3.)*wgt[: n_fast]
+        emis['th'] = nd**2*sigv(Ti)*wgt
+        emis['bb'] = dens**2*sigv(2.*E_mean/3.)*wgt[: n_fast]
+        return emis
+
+
+    def sample_allocation(self, sampling='sqrt', budget=None, n_min=16):
+        '''MC samples per cell and component, proportional to the estimated contribution w (sampling='linear')
+or to sqrt(w) (sampling='sqrt', minimum variance of the summed spectrum), with a total budget per component
+(default: samples_per_volume_element per cell). Rounded down to powers of 2, so that few SpectrumCalculator
+instances are needed, then the cells furthest below their share are doubled while the total stays within the budget
+(exceeded only if n_min samples for every cell do not fit). Each cell's DRESS result is normalised by its own sample count, so no reweighting is needed'''
+
+        samples_d = {}
+        for reac, emis in self.cell_emission().items():
+            n_cells = len(emis)
+            n_budget = self.samples_per_volume_element*n_cells if budget is None else budget
+            w = np.maximum(emis, 0.) if sampling == 'linear' else np.sqrt(np.maximum(emis, 0.))
+            if np.sum(w) <= 0:
+                n_samp = np.full(n_cells, float(n_budget)/n_cells)
+            else:
+                n_samp = n_budget*w/np.sum(w)
+            n_share = np.maximum(n_samp, n_min)
+            n_samp = 2**np.floor(np.log2(n_share))
+            order = np.argsort(n_samp/n_share) # largest rounding loss first
+            n_fit = np.searchsorted(np.cumsum(n_samp[order]), n_budget - np.sum(n_samp), side='right')
+            n_samp[order[: n_fit]] *= 2
+            samples_d[reac] = n_samp.astype(np.int64)
+            logger.info('%s: %d samples (budget %d), levels %s', reac, np.sum(samples_d[reac]), n_budget, np.unique(samples_d[reac]))
+        return samples_d
+
+
+    def split_cells(self, n_proc, samples_d=None, chunks_per_proc=4, reacs=('bt', 'th', 'bb')):
+        '''Tasks (reac, cell indices, n_samples) of roughly equal estimated cost, about chunks_per_proc tasks per process overall,
+sorted by decreasing cost. With samples_d ({reac: samples per cell}) the cells of each sample level are split separately'''
+
+        cost_d = {reac: cost for reac, cost in self.cell_cost().items() if reac in reacs}
+        if samples_d is None:
+            samples_d = {reac: np.full(len(cost), self.samples_per_volume_element) for reac, cost in cost_d.items()}
+        total = sum([np.sum(cost*samples_d[reac]) for reac, cost in cost_d.items()])
+        target = total/(chunks_per_proc*n_proc)
+        tasks = []
+        for reac, cost in cost_d.items():
+            for n_samp in np.unique(samples_d[reac]):
+                idx = np.where(samples_d[reac] == n_samp)[0]
+                cum = np.cumsum(cost[idx]*n_samp)
+                n_chunk = min(len(idx), max(1, int(np.ceil(cum[-1]/target))))
+                edges = np.searchsorted(cum, cum[-1]*np.arange(1, n_chunk)/n_chunk)
+                edges = np.unique(np.concatenate(([0], edges, [len(idx)])))
+                for j0, j1 in zip(edges[:-1], edges[1:]):
+                    tasks.append((cum[j1-1] - (cum[j0-1] if j0 > 0 else 0.), (reac, idx[j0: j1], n_samp.item())))
+        tasks.sort(key=lambda task: -task[0])
+        return [task for cost, task in tasks]
+
+
+    def run(self, parallel=True, sampling=None, budget=None, th_analytic=False):
+        '''Execute DRESS calculation, computing Neutron Emission Spectra: beam-target, thermonuclear, beam-beam.
+sampling='sqrt' or 'linear': two-pass mode, MC samples per cell allocated from the estimated emission (see sample_allocation).
+th_analytic=True: thermonuclear component from tabulated Brysk spectra instead of DRESS MC'''
 
         logger.info('Running DRESS, #MC %d', self.samples_per_volume_element)
 
         Ncells = len(self.dressInput['rho'])
 
         Bdir = np.atleast_2d([0, -1, 0])
-        B_dir = np.repeat(Bdir, Ncells, axis=0)   # B-dir for each spatial location
 
         if 'v_rot' not in self.dressInput.keys():
             self.dressInput['v_rot'] = np.zeros((Ncells, 3), dtype=flt)
             if 'ang_freq' in self.dressInput.keys():
                 self.dressInput['v_rot'][:, 1] = self.dressInput['ang_freq']*self.dressInput['R']
 
-        dd    = dress.reactions.DDNHe3Reaction()
-        scalc = dress.SpectrumCalculator(dd, n_samples=self.samples_per_volume_element)
-
 # Neutron energy bins [keV]
         bin_keV = 10.
         En_bins = np.arange(1500, 3500, bin_keV)    # bin edges
@@ -107,56 +509,57 @@ class nSpectrum:
 
 # Compute spectra components
 
+        samples_d = None if sampling is None else self.sample_allocation(sampling=sampling, budget=budget)
+        reacs = ('bt', 'bb') if th_analytic else ('bt', 'th', 'bb')
+        const_d = {'E': self.dressInput['E'], 'pitch': self.dressInput['pitch'], 'En_bins': En_bins, 'Bdir': Bdir, \
+            'chan_wgt': None if self.chan_wgt is None else csc_matrix(self.chan_wgt), 'quiet': parallel}
         if parallel:
-# Split arrays
-
-            self.dressSplit = {}
-            n_split = 20
-            for key in ('dV', 'solidAngle', 'R', 'Z', 'density', 'F', 'nd', 'Ti', 'v_rot'):
-                self.dressSplit[key] = np.array_split(self.dressInput[key], n_split)
-            vols_spl = {}
-            fast_spl = {}
-            bulk_spl = {}
-            for j in range(n_split):
-                Nvols = len(self.dressSplit['dV'][j])
-                B_dir = np.repeat(Bdir, Nvols, axis=0)   # B-dir for each spatial location
-                vols_spl[j] = dress.utils.make_vols(self.dressSplit['dV'][j], self.dressSplit['solidAngle'][j], pos=(self.dressSplit['R'][j], self.dressSplit['Z'][j]))
-                fast_spl[j] = dress.utils.make_dist('energy-pitch', 'd', Nvols, self.dressSplit['density'][j],
-                energy_axis=self.dressInput['E'], pitch_axis=self.dressInput['pitch'], distvals=self.dressSplit['F'][j], ref_dir=B_dir)
-                bulk_spl[j] = dress.utils.make_dist('maxwellian', 'd', Nvols, self.dressSplit['nd'][j], temperature=self.dressSplit['Ti'][j], v_collective=self.dressSplit['v_rot'][j])
-
-            timeout_pool = 2000
-            pool = Pool(cpu_count())
-            logger.info('Computing beam-target')
-            bt = pool.map_async( calcvols, [(vols_spl[j], fast_spl[j], bulk_spl[j], scalc, En_bins) for j in range(n_split)]).get(timeout_pool)
-            logger.info('Computing thermonuclear')
-            th = pool.map_async( calcvols, [(vols_spl[j], bulk_spl[j], bulk_spl[j], scalc, En_bins) for j in range(n_split)]).get(timeout_pool)
-            logger.info('Computing beam-beam')
-            bb = pool.map_async( calcvols, [(vols_spl[j], fast_spl[j], fast_spl[j], scalc, En_bins) for j in range(n_split)]).get(timeout_pool)
-            bt = np.array(bt)
-            th = np.array(th)
-            bb = np.array(bb)
-            self.bt = np.sum(bt, axis=0)
-            self.th = np.sum(th, axis=0)
-            self.bb = np.sum(bb, axis=0)
+# Input arrays in shared memory once; cost-balanced tasks of cell indices for the MC components, largest first
+
+            n_proc = cpu_count()
+            tasks = self.split_cells(n_proc, samples_d=samples_d, reacs=reacs)
+            shm_l, spec = share_arrays({key: self.dressInput[key] for key in shared_keys})
+            logger.info('Computing %s in %d tasks on %d processes', ', '.join(reacs), len(tasks), n_proc)
+            spec_d = {}
+            try:
+                with Pool(n_proc, initializer=init_worker, initargs=(spec, const_d)) as pool:
+                    for reac, nes in pool.imap_unordered(calcchunk, tasks):
+                        spec_d[reac] = nes if reac not in spec_d else spec_d[reac] + nes
+            finally:
+                for shm in shm_l:
+                    shm.close()
+                    shm.unlink()
+            self.bt = spec_d['bt']
+            self.bb = spec_d['bb']
         else:
-            vols = dress.utils.make_vols(self.dressInput['dV'], self.dressInput['solidAngle'], pos=(self.dressInput['R'], self.dressInput['Z']))
-            fast_dist = dress.utils.make_dist('energy-pitch', 'd', Ncells, self.dressInput['density'],
-                energy_axis=self.dressInput['E'], pitch_axis=self.dressInput['pitch'], distvals=self.dressInput['F'], ref_dir=B_dir)
-            bulk_dist = dress.utils.make_dist('maxwellian', 'd', Ncells, self.dressInput['nd'], temperature=self.dressInput['Ti'], v_collective=self.dressInput['v_rot'])
-            logger.debug('T #nan: %d, #T<=0: %d', np.sum(np.isnan(bulk_dist.T)), np.sum(bulk_dist.T <= 0))
-            logger.debug('nd #nan: %d, #nd<=0: %d', np.sum(np.isnan(bulk_dist.density)), np.sum(bulk_dist.density <= 0))
-            logger.info('Computing beam-target')
-            self.bt = dress.utils.calc_vols(vols, fast_dist, bulk_dist, scalc, En_bins, integrate=True, quiet=False)
-            logger.info('Computing thermonuclear')
-            self.th = dress.utils.calc_vols(vols, bulk_dist, bulk_dist, scalc, En_bins, integrate=True, quiet=False)
-            logger.info('Computing beam-beam')
-            self.bb = dress.utils.calc_vols(vols, fast_dist, fast_dist, scalc, En_bins, integrate=True, quiet=False)     
+            logger.debug('T #nan: %d, #T<=0: %d', np.sum(np.isnan(self.dressInput['Ti'])), np.sum(self.dressInput['Ti'] <= 0))
+            logger.debug('nd #nan: %d, #nd<=0: %d', np.sum(np.isnan(self.dressInput['nd'])), np.sum(self.dressInput['nd'] <= 0))
+            init_worker({key: self.dressInput[key] for key in shared_keys}, const_d)
+            spec_d = {}
+            for reac, idx, n_samp in self.split_cells(1, samples_d=samples_d, chunks_per_proc=1, reacs=reacs):
+                logger.info('Computing %s, %d cells, #MC %d', reac, len(idx), n_samp)
+                nes = calcchunk((reac, idx, n_samp))[1]
+                spec_d[reac] = nes if reac not in spec_d else spec_d[reac] + nes
+            self.bt = spec_d['bt']
+            self.bb = spec_d['bb']
+            worker_d.clear()
+        if th_analytic:
+            logger.info('Computing thermonuclear, analytic')
+            self.th = self.th_analytic(En_bins)
+        else:
+            self.th = spec_d['th']
 
         for spec in self.bt, self.bb, self.th:
             spec /= bin_keV
         self.bb *= 0.5
         self.th *= 0.5
+        if self.chan_wgt is not None: # keep channel spectra, totals in bt, th, bb
+            self.bt_chan = self.bt
+            self.th_chan = self.th
+            self.bb_chan = self.bb
+            self.bt = np.sum(self.bt_chan, axis=0)
+            self.th = np.sum(self.th_chan, axis=0)
+            self.bb = np.sum(self.bb_chan, axis=0)
 
         rate_bt = bin_keV*np.sum(self.bt)
         rate_th = bin_keV*np.sum(self.th)
@@ -173,26 +576,21 @@ class nSpectrum:
             logger.info('Total neutron rate %12.4e N/s', rate_bt + rate_th + rate_bb)
 
 
-    def nes2phs(self, f_resp='responses/rm_bg.cdf'):
-
-        resp = response.RESP()
-        fname, ext = os.path.splitext(f_resp)
-        if ext.lower() == '.cdf':
-            resp.from_cdf(f_resp)
-        else:
-            resp.from_hepro(f_resp)
+    def nes2phs(self, f_resp='responses/rm_bg.cdf', kind='nearest'):
+        '''Fold the neutron spectra into Pulse Height Spectra; kind='nearest' or 'linear' in neutron energy'''
 
+        resp = read_resp(f_resp)
         En_MeV = 1e-3*self.En
-        nbins = len(resp.Ephs_MeVee)
         self.phs = {}
         self.phs['Elight_MeVee'] = resp.Ephs_MeVee
 
-        for reac in ('bt', 'bb', 'th'):
-            self.phs[reac] = np.zeros(nbins, dtype=flt)
-            for jEn, En in enumerate(En_MeV):
-                dist = (resp.En_MeV - En)**2
-                jclose = np.argmin(dist)
-                self.phs[reac] += self.__dict__[reac][jEn]*resp.RespMat[jclose, :]
+# All spectral components folded at once
+        reacs = ('bt', 'bb', 'th')
+        phs = resp.fold(En_MeV, np.vstack([self.__dict__[reac] for reac in reacs]), kind=kind, dtype=flt)
+        for jreac, reac in enumerate(reacs):
+            self.phs[reac] = phs[jreac]
+            if hasattr(self, '%s_chan' %reac):
+                self.phs['%s_chan' %reac] = resp.fold(En_MeV, self.__dict__['%s_chan' %reac], kind=kind, dtype=flt)
 
 
     def storeSpectra(self, f_out='dress_client/output/Spectrum.dat'):
@@ -242,7 +640,8 @@ class nSpectrum:
         plt.ylabel('Z (m)')
         plt.axis('scaled')
 
-# Plot the (E, pitch) distribution at a given MC cell
+# Plot the (E, pitch) distribution at a given MC cell; after compression F covers only the first n_fast cells
+        jcell = min(jcell, len(self.dressInput['F']) - 1)
         plt.figure()
         R = self.dressInput['R'][jcell]
         Z = self.dressInput['Z'][jcell]
@@ -290,7 +689,107 @@ class nSpectrum:
             plt.title('Total Pulse Height')
 
         return fig
-        
+
+
+class nSpectrumTime(nSpectrum):
+    '''Neutron spectra for a sequence of time slices (one distribution file each).
+The LoS file, the LoS -> distribution mapping and the response matrix are set up once;
+the next slice is read in a background thread while DRESS runs on the current one'''
+
+
+    def __init__(self, f_in1, f_in2, f_los=None, src='transp', samples_per_volume_element=1e4, los_interp='nearest', aggregate=True, f_resp=None, cache=False, cell_tol=0., grid_tol=0., reader_kw=None):
+
+        single = lambda f: f is None or isinstance(f, str)
+        n_files = {len(f) for f in (f_in1, f_in2) if not single(f)}
+        if len(n_files) != 1 or 0 in n_files:
+            raise ValueError('nSpectrumTime: f_in1 and/or f_in2 must be a non-empty list of files, one per time slice, with equal lengths')
+        n_slices = n_files.pop()
+        self.f_in1 = n_slices*[f_in1] if single(f_in1) else list(f_in1)
+        self.f_in2 = n_slices*[f_in2] if single(f_in2) else list(f_in2)
+        self.set_options(f_los, src, samples_per_volume_element, los_interp, aggregate, cache, cell_tol, grid_tol, reader_kw)
+        self.resp = None if f_resp is None else read_resp(f_resp)
+        self.kind = 'nearest'
+
+
+    def run(self, parallel=True, sampling=None, budget=None, th_analytic=False):
+        '''DRESS spectra for all time slices, stacked into (n_time, n_En) arrays; options as in nSpectrum.run'''
+
+        n_slices = len(self.f_in1)
+        self.time = np.zeros(n_slices, dtype=flt)
+        stack_d = {}
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            future = reader.submit(read_code, self.code, self.f_in1[0], self.f_in2[0], self.cache, self.reader_kw)
+            for jt in range(n_slices):
+                self.codeClass = future.result()
+                if jt < n_slices - 1: # prefetch
+                    future = reader.submit(read_code, self.code, self.f_in1[jt+1], self.f_in2[jt+1], self.cache, self.reader_kw)
+                self.time[jt] = self.codeClass.time
+                logger.info('Time slice %d/%d, t = %8.4f s', jt + 1, n_slices, self.time[jt])
+                self.set_input()
+                nSpectrum.run(self, parallel=parallel, sampling=sampling, budget=budget, th_analytic=th_analytic)
+                for reac in ('bt', 'th', 'bb', 'bt_chan', 'th_chan', 'bb_chan'):
+                    if hasattr(self, reac):
+                        if reac not in stack_d:
+                            stack_d[reac] = np.zeros((n_slices, ) + self.__dict__[reac].shape, dtype=flt)
+                        stack_d[reac][jt] = self.__dict__[reac]
+        self.__dict__.update(stack_d)
+        if self.resp is not None:
+            self.nes2phs(kind=self.kind)
+
+
+    def nes2phs(self, f_resp=None, kind='nearest'):
+        '''Fold all time slices with the response matrix read once'''
+
+        if f_resp is not None:
+            self.resp = read_resp(f_resp)
+        En_MeV = 1e-3*self.En
+        self.phs = {}
+        self.phs['Elight_MeVee'] = self.resp.Ephs_MeVee
+        for reac in ('bt', 'bb', 'th', 'bt_chan', 'th_chan', 'bb_chan'):
+            if hasattr(self, reac):
+                nes = self.__dict__[reac]
+                phs = self.resp.fold(En_MeV, nes.reshape(-1, nes.shape[-1]), kind=kind, dtype=flt)
+                self.phs[reac] = phs.reshape(nes.shape[:-1] + phs.shape[-1:])
+
+
+    def plotInput(self, jcell=100, jt=0):
+        '''Plot the DRESS input of time slice jt'''
+
+        self.codeClass = read_code(self.code, self.f_in1[jt], self.f_in2[jt], cache=self.cache, reader_kw=self.reader_kw)
+        self.set_input()
+        nSpectrum.plotInput(self, jcell=jcell)
+
+
+    def plotSpectra(self, jt=-1):
+        '''Plot the spectra of time slice jt'''
+
+        spec = nSpectrum.__new__(nSpectrum)
+        spec.En  = self.En
+        spec.los = self.los
+        for reac in ('bt', 'th', 'bb'):
+            spec.__dict__[reac] = self.__dict__[reac][jt]
+        spec.phs = {key: (val if key == 'Elight_MeVee' else val[jt]) for key, val in self.phs.items()}
+        fig = nSpectrum.plotSpectra(spec)
+        fig.suptitle('t = %8.4f s' %self.time[jt])
+        return fig
+
+
+    def storeSpectra(self, f_out='dress_client/output/Spectrum_time.h5'):
+        '''Store the (time, energy) spectra in one HDF5 file'''
+
+        with h5py.File(f_out, 'w') as f:
+            f.create_dataset('time', data=self.time)
+            f.create_dataset('En'  , data=self.En)
+            f['En'].attrs['unit'] = 'keV'
+            for reac in ('th', 'bt', 'bb', 'th_chan', 'bt_chan', 'bb_chan'):
+                if hasattr(self, reac):
+                    f.create_dataset(reac, data=self.__dict__[reac])
+            if hasattr(self, 'phs'):
+                grp = f.create_group('phs')
+                for key, val in self.phs.items():
+                    grp.create_dataset(key, data=val)
+        logger.info('Stored file %s', f_out)
+
 
 if __name__ == '__main__':
 
@@ -1,11 +1,152 @@
-import logging
+import json, logging
 import numpy as np
+import h5py
 import matplotlib.pylab as plt
+from matplotlib.path import Path
+from multiprocessing import Pool, cpu_count
+from scipy.interpolate import RegularGridInterpolator
 
 logger = logging.getLogger('neutReac.los')
 logger.setLevel(logging.DEBUG)
 
 
+cell_keys = ('x', 'y', 'z', 'omega', 'vol')
+
+
+def read_los(f_los, mmap=True):
+    '''Read a LOS cell file, binary (HDF5) or legacy ASCII, detected from the file content.
+Returns a dict with the cell arrays x, y, z, omega, vol and, for HDF5, the metadata 'geo' and 'det'.
+Contiguous HDF5 datasets are memory-mapped if mmap=True'''
+
+    los_d = {}
+    if h5py.is_hdf5(f_los):
+        logger.info('Reading binary LOS file %s', f_los)
+        with h5py.File(f_los, 'r') as f:
+            for key, dset in f['cells'].items():
+                offset = dset.id.get_offset()
+                if mmap and offset is not None and dset.chunks is None and dset.compression is None:
+                    los_d[key] = np.memmap(f_los, mode='r', dtype=dset.dtype, offset=offset, shape=dset.shape)
+                else:
+                    los_d[key] = dset[()]
+            los_d['geo'] = json.loads(f.attrs['geo'])
+            los_d['det'] = {key: val for key, val in f['detector'].attrs.items()}
+    else:
+        logger.info('Reading ASCII LOS file %s', f_los)
+        for key, arr in zip(cell_keys, np.loadtxt(f_los, unpack=True)):
+            los_d[key] = arr
+
+    return los_d
+
+
+def segment(r, x0):
+    '''Area and centroid distance (from the circle centre) of the segment of a circle of radius r beyond the chord at signed distance x0'''
+
+    x0 = np.clip(x0, -r, r)
+    half_chord = np.sqrt(r**2 - x0**2)
+    area = r**2*np.arccos(x0/r) - x0*half_chord
+    xbar = 2.*half_chord**3/(3.*np.where(area > 0, area, 1.))
+    return area, xbar
+
+
+def lens(r1, r2, c):
+    '''Intersection of a circle (radius r1, centred at 0) and a circle (radius r2, centred at c >= 0) on a line.
+Returns the area and the position of its centroid along the line of centres (vectorised)'''
+
+    r1, r2, c = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in (r1, r2, c)])
+    area = np.zeros(r1.shape)
+    xbar = np.zeros(r1.shape)
+
+    inner = c <= np.abs(r1 - r2) # one circle inside the other
+    small1 = inner & (r1 <= r2)
+    area[small1] = np.pi*r1[small1]**2
+    small2 = inner & (r1 > r2)
+    area[small2] = np.pi*r2[small2]**2
+    xbar[small2] = c[small2]
+
+    part = (~inner) & (c < r1 + r2)
+    cp = np.where(part, c, 1.)
+    x0 = (cp**2 + r1**2 - r2**2)/(2.*cp) # chord position
+    a1, xb1 = segment(r1, x0)
+    a2, xb2 = segment(r2, cp - x0)
+    a12 = np.where(a1 + a2 > 0, a1 + a2, 1.)
+    area[part] = (a1 + a2)[part]
+    xbar[part] = ((a1*xb1 + a2*(cp - xb2))/a12)[part]
+
+    return area, xbar
+
+
+def solid_angle(dist, rho, det_radius, coll_radius, d_det_coll):
+    '''Solid angle of a disk detector behind a coaxial circular collimator aperture,
+seen from points at axial distance dist from the detector and off-axis distance rho.
+The aperture is projected onto the detector plane; the visible area is the lens
+detector-projection, weighted with cos(theta)/r**2 at its centroid'''
+
+    dist = np.asarray(dist, dtype=np.float64)
+    rho  = np.asarray(rho , dtype=np.float64)
+    lever = dist - d_det_coll
+    r_proj = coll_radius*dist/lever
+    c_proj = rho*d_det_coll/lever # projected aperture centre, opposite side of the point
+    area, xbar = lens(det_radius, r_proj, c_proj)
+    r2 = (rho + xbar)**2 + dist**2
+
+    return area*dist/r2**1.5
+
+
+class OMEGA_TABLE:
+    '''Lookup table of the detector solid angle on (distance, rho/cone_radius), with ring averages'''
+
+
+    def __init__(self, geo, dist_lim, offset, tan_cone_aper, n_dist=256, n_rho=128):
+
+        self.offset = offset
+        self.tan_cone_aper = tan_cone_aper
+        self.dist = np.linspace(dist_lim[0], dist_lim[1], n_dist)
+        self.srho = np.linspace(0., 1., n_rho)
+        rho = self.srho[None, :]*self.cone_radius(self.dist)[:, None]
+        omega = solid_angle(self.dist[:, None], rho, geo['det_radius'], 0.5*geo['coll_diam'], geo['d_det_coll'])
+        self.interp = RegularGridInterpolator((self.dist, self.srho), omega, bounds_error=False, fill_value=0.)
+
+
+    def cone_radius(self, dist):
+
+        return np.maximum((dist - self.offset)*self.tan_cone_aper, 1e-12)
+
+
+    def __call__(self, dist, rho):
+
+        dist = np.clip(dist, self.dist[0], self.dist[-1])
+        srho = rho/self.cone_radius(dist)
+        return self.interp(np.stack(np.broadcast_arrays(dist, srho), axis=-1))
+
+
+    def ring_average(self, dist, rho_in, rho_out, dthick, n_gauss=4):
+        '''Average over annuli [rho_in, rho_out] (area weighted) and over the disk thickness'''
+
+        t, w = np.polynomial.legendre.leggauss(n_gauss)
+        rho = rho_in[:, None] + 0.5*(rho_out - rho_in)[:, None]*(1. + t[None, :])
+        wrho = w[None, :]*rho
+        om = np.zeros(len(dist))
+        for dd in (-0.5/np.sqrt(3.), 0.5/np.sqrt(3.)): # 2-point Gauss along the LOS
+            om += 0.5*np.sum(wrho*self(dist[:, None] + dd*dthick, rho), axis=1)
+        return om/np.sum(wrho, axis=1)
+
+
+def write_hdf5(los_file, cell_d, geo, det_d):
+    '''Binary LOS file: cell arrays as contiguous (mmap-able) datasets, geometry as JSON, detector metadata as attributes'''
+
+    logger.info('Storing binary output, n_cells=%d', len(cell_d['vol']))
+    with h5py.File(los_file, 'w') as f:
+        f.attrs['geo'] = json.dumps(geo)
+        cells = f.create_group('cells')
+        for key, arr in cell_d.items():
+            dtyp = np.int32 if key == 'los_index' else np.float64
+            cells.create_dataset(key, data=np.asarray(arr, dtype=dtyp))
+        det = f.create_group('detector')
+        for key, val in det_d.items():
+            det.attrs[key] = val
+    logger.info('Written output file %s' %los_file)
+
+
 class CELL:
     pass
 
@@ -59,9 +200,15 @@ class XYLOS:
 
 class DETECTOR_LOS:
 
-    def __init__(self, geo):
+    def __init__(self, geo, emissivity=None):
+        '''geo: detector geometry dict; with geo['adapt_tol'] > 0 the cells are coarsened adaptively,
+weighting them by omega*vol*emissivity(R, z), which is then required'''
+
         self.geo = geo
         self.run()
+        tol = geo.get('adapt_tol', 0.)
+        if tol > 0:
+            self.adapt(tol, emissivity=emissivity)
 
     def run(self):
 
@@ -117,46 +264,176 @@ class DETECTOR_LOS:
 # of the circular sector
 
         self.cell = CELL()
-        self.cell.x     = []
-        self.cell.y     = []
-        self.cell.z     = []
-        self.cell.omega = []
-        self.cell.vol   = []
-
-        for jdisk in range(n_disks):
-            n_circles = int(0.5 + disk_radius[jdisk]/self.geo['cell_radius'])
-            delta_radius = disk_radius[jdisk]/float(n_circles)
-
-# radius, alpha in the 'middle' of the sector
-# The central circle has only one sector (cell)
-            cvol = np.pi * delta_radius**2 * dy
-            self.cell.vol = np.append(self.cell.vol, np.repeat(cvol, n_circles**2))
-
-            radius = (0.5 + np.arange(n_circles))*delta_radius
-            radius[0] = 0.
-            omega_fac = np.pi * self.geo['det_radius']**2/det_dist[jdisk]**3
-            cell_detDist = np.hypot(det_dist[jdisk], radius)
-            omegaCircle = omega_fac * cell_detDist
-            for j_circle in range(n_circles):
-                n_sectors = 2*j_circle + 1
-                self.cell.omega += n_sectors*[omegaCircle[j_circle]]
+
+# Per-disk circle counts, then per-circle sector counts; cumulative offsets
+# and np.repeat fill all cell arrays at once, ordered disk -> circle -> sector
+
+        n_circles = (0.5 + disk_radius/self.geo['cell_radius']).astype(np.int64)
+        delta_radius = disk_radius/np.maximum(n_circles, 1)
+        cvol = np.pi * delta_radius**2 * dy
+        det_dist3 = np.array([dist**3 for dist in det_dist]) # O(n_disks); scalar pow keeps results bit-identical
+        omega_fac = np.pi * self.geo['det_radius']**2/det_dist3
+
+        jdisk_circ = np.repeat(np.arange(n_disks), n_circles)
+        circ_offset = np.cumsum(n_circles) - n_circles
+        j_circle = np.arange(len(jdisk_circ)) - np.repeat(circ_offset, n_circles)
+        radius = (0.5 + j_circle)*delta_radius[jdisk_circ]
+        radius[j_circle == 0] = 0.
+        if self.geo.get('solid_angle', 'cone').lower() == 'exact':
+# Detector solid angle behind the collimator, averaged over each annulus [j, j+1]*delta_radius
+            self.omega_tab = OMEGA_TABLE(self.geo, (np.min(det_dist), np.max(det_dist)), offset, self.det.tan_cone_aper)
+            rho_in = j_circle*delta_radius[jdisk_circ]
+            omegaCircle = self.omega_tab.ring_average(det_dist[jdisk_circ], rho_in, rho_in + delta_radius[jdisk_circ], self.geo['disk_thick'])
+        else:
+            omegaCircle = omega_fac[jdisk_circ] * np.hypot(det_dist[jdisk_circ], radius)
+
 # Poloidal sectors (cells) in a circle
-                alpha = np.linspace(0, 2.*np.pi, n_sectors, endpoint=False)
-                rcos  = list(radius[j_circle]*np.cos(alpha))
-                rssin = list(-self.det.los.y[jdisk] - radius[j_circle]*np.sin(alpha)*stilt)
-                rcsin = list( self.det.los.z[jdisk] + radius[j_circle]*np.sin(alpha)*ctilt)
+        n_sectors = 2*j_circle + 1
+        jcirc_cell = np.repeat(np.arange(len(j_circle)), n_sectors)
+        sect_offset = np.cumsum(n_sectors) - n_sectors
+        j_sector = np.arange(len(jcirc_cell)) - np.repeat(sect_offset, n_sectors)
+        alpha = j_sector*(2.*np.pi/n_sectors[jcirc_cell])
+        jdisk_cell = jdisk_circ[jcirc_cell]
+        rad_cell = radius[jcirc_cell]
+
 # cell_pos: with respect to torus center
-                self.cell.x += rcos
-                self.cell.y += rssin
-                self.cell.z += rcsin
-        self.cell.x = np.array(self.cell.x) + self.det.pos[0]
-        self.cell.y = np.array(self.cell.y)
-        self.cell.z = np.array(self.cell.z)
-        self.cell.omega = np.array(self.cell.omega)
+        self.cell.x = rad_cell*np.cos(alpha) + self.det.pos[0]
+        self.cell.y = -self.det.los.y[jdisk_cell] - rad_cell*np.sin(alpha)*stilt
+        self.cell.z =  self.det.los.z[jdisk_cell] + rad_cell*np.sin(alpha)*ctilt
+        self.cell.omega = omegaCircle[jcirc_cell]
+        self.cell.vol = cvol[jdisk_cell]
+        self.cell_disk  = jdisk_cell
+        self.cell_trans = j_circle[jcirc_cell]**2 + j_sector # transverse index within a disk
         logger.info('Done LOS cone calculation')
 
 
-    def writeLOS(self):
+    def adapt(self, tol, emissivity=None, max_iter=4):
+        '''Merge cells where the weight omega*vol*emissivity varies slowly, up to a relative error tol
+on the LOS-integrated weight. Along the LOS consecutive disks are merged into groups; within a group
+the transverse cells collapse into one if the emissivity is flat across the cone.
+Cells are only merged, never refined below the input grid; if max_iter passes with tighter internal
+targets do not reach tol, the fine cells are kept.
+Coarse cells conserve sum(vol) and sum(omega*vol); positions are volume-weighted centroids'''
+
+        if emissivity is None:
+            raise ValueError('Adaptive LOS coarsening needs an emissivity(R, z) function')
+
+        x, y, z = self.cell.x, self.cell.y, self.cell.z
+        omega, vol = self.cell.omega, self.cell.vol
+        n_fine = len(vol)
+        emis = np.asarray(emissivity(np.hypot(x, y), z), dtype=np.float64)
+        q_cell = omega*vol*emis
+        Q_tot = np.sum(q_cell)
+        if Q_tot <= 0:
+            logger.warning('Zero LOS weight, no adaptive coarsening')
+            return
+
+        jdisk = self.cell_disk
+        n_disks = len(self.det.los.y)
+        Q_disk = np.bincount(jdisk, weights=q_cell   , minlength=n_disks)
+        W_disk = np.bincount(jdisk, weights=omega*vol, minlength=n_disks)
+        V_disk = np.bincount(jdisk, weights=vol      , minlength=n_disks)
+        V_disk[V_disk <= 0] = 1.
+
+# Transverse error: collapsing a disk into one cell at its centroid
+        xd = np.bincount(jdisk, weights=x*vol, minlength=n_disks)/V_disk
+        yd = np.bincount(jdisk, weights=y*vol, minlength=n_disks)/V_disk
+        zd = np.bincount(jdisk, weights=z*vol, minlength=n_disks)/V_disk
+        err_trans = np.abs(Q_disk - W_disk*np.asarray(emissivity(np.hypot(xd, yd), zd)))
+
+# Along the LOS: midpoint-rule error of a group of n disks ~ n**3/24*|d2Q|
+        d2Q = np.zeros(n_disks)
+        if n_disks > 2:
+            d2Q[1:-1] = np.abs(np.diff(Q_disk, 2))
+            d2Q[0]  = d2Q[1]
+            d2Q[-1] = d2Q[-2]
+
+        tol_target = tol
+        rel_err = np.inf
+        for jiter in range(max_iter):
+            budget = 0.5*tol_target*Q_tot/n_disks # per disk, half for LOS merging, half for transverse
+
+# Greedy grouping of consecutive disks
+            group = np.zeros(n_disks, dtype=np.int64)
+            jgroup = 0
+            jstart = 0
+            d2max = d2Q[0]
+            for jd in range(1, n_disks):
+                d2loc = max(d2max, d2Q[jd])
+                n_g = jd - jstart + 1
+                if n_g**2*d2loc <= 24.*budget:
+                    d2max = d2loc
+                else:
+                    jgroup += 1
+                    jstart = jd
+                    d2max = d2Q[jd]
+                group[jd] = jgroup
+            n_groups = jgroup + 1
+
+# Transverse collapse per group
+            n_g = np.bincount(group, minlength=n_groups)
+            flat = np.bincount(group, weights=err_trans, minlength=n_groups) <= budget*n_g
+            trans = np.where(flat[group[jdisk]], 0, 1 + self.cell_trans)
+            label = group[jdisk]*(2 + np.max(self.cell_trans)) + trans
+            ulabel, jcoarse = np.unique(label, return_inverse=True)
+
+            n_coarse = len(ulabel)
+            c_vol = np.bincount(jcoarse, weights=vol, minlength=n_coarse)
+            c_x = np.bincount(jcoarse, weights=x*vol, minlength=n_coarse)/c_vol
+            c_y = np.bincount(jcoarse, weights=y*vol, minlength=n_coarse)/c_vol
+            c_z = np.bincount(jcoarse, weights=z*vol, minlength=n_coarse)/c_vol
+            c_omega = np.bincount(jcoarse, weights=omega*vol, minlength=n_coarse)/c_vol
+
+            Q_coarse = np.sum(c_omega*c_vol*np.asarray(emissivity(np.hypot(c_x, c_y), c_z)))
+            rel_err = np.abs(Q_coarse - Q_tot)/Q_tot
+            logger.debug('Adaptive LOS, iteration %d: %d cells, rel. error %10.3e', jiter, n_coarse, rel_err)
+            if rel_err <= tol:
+                break
+            tol_target *= 0.5
+        else:
+            logger.warning('Adaptive LOS: rel. error %10.3e > %10.3e after %d iterations, keeping the %d fine cells', rel_err, tol, max_iter, n_fine)
+            return
+
+        self.cell.x, self.cell.y, self.cell.z = c_x, c_y, c_z
+        self.cell.omega = c_omega
+        self.cell.vol   = c_vol
+        self.cell_disk  = None
+        self.cell_trans = None
+        logger.info('Adaptive LOS: %d -> %d cells, %d disk groups', n_fine, n_coarse, n_groups)
+
+
+    def writeLOS(self, fmt='hdf5'):
+        '''Store the LOS cells: fmt='hdf5' (binary, default) or 'ascii' (legacy)'''
+
+        if fmt.lower() == 'ascii':
+            self.writeASCII()
+        else:
+            self.writeHDF5()
+
+
+    def det_meta(self):
+        '''Detector metadata stored with the binary LOS file'''
+
+        ctilt = np.cos(np.radians(self.geo['tilt']))
+        det_d = {}
+        det_d['position'] = self.det.pos
+        det_d['radius'] = self.geo['det_radius']
+        det_d['cone_aperture_deg'] = np.degrees(np.arctan(self.det.tan_cone_aper))
+        det_d['disk_thick'] = self.geo['disk_thick']*ctilt
+        det_d['n_disks'] = len(self.det.los.y)
+        det_d['los_y'] = (self.det.los.y[0], self.det.los.y[-1])
+        det_d['los_z'] = (self.det.los.z[0], self.det.los.z[-1])
+        return det_d
+
+
+    def writeHDF5(self):
+
+        los_file = 'los/%s.h5' %self.geo['label']
+        cell_d = {key: self.cell.__dict__[key] for key in cell_keys}
+        write_hdf5(los_file, cell_d, self.geo, self.det_meta())
+
+
+    def writeASCII(self):
 
         n_cells = len(self.cell.vol)
         n_disks = len(self.det.los.y)
@@ -234,3 +511,54 @@ x             y             z             Omega         Vol
         else:
             return fig
         
+
+
+def los_cells(geo):
+    '''Cells and detector metadata of one LOS, picklable for multiprocessing'''
+
+    dlos = DETECTOR_LOS(geo)
+    return {key: dlos.cell.__dict__[key] for key in cell_keys}, dlos.det_meta()
+
+
+class MULTI_LOS:
+    '''Batch of detector LOS sharing one plasma domain, e.g. a camera.
+geo_list: list of geometry dicts (as for DETECTOR_LOS), or a JSON file with such a list.
+Rz_domain: optional (R, z) polygon; cells outside are dropped once for the combined set.
+The combined cells carry 'los_index', the channel of each cell'''
+
+
+    def __init__(self, geo_list, Rz_domain=None, parallel=True):
+
+        if isinstance(geo_list, str):
+            with open(geo_list, 'r') as fjson:
+                geo_list = json.load(fjson)
+        self.geo = geo_list
+        n_los = len(geo_list)
+
+        if parallel and n_los > 1:
+            with Pool(min(cpu_count(), n_los)) as pool:
+                out = pool.map(los_cells, geo_list)
+        else:
+            out = [los_cells(geo) for geo in geo_list]
+
+        n_cells = [len(cell_d['vol']) for cell_d, _ in out]
+        self.cell = CELL()
+        for key in cell_keys:
+            self.cell.__dict__[key] = np.concatenate([cell_d[key] for cell_d, _ in out])
+        self.cell.los_index = np.repeat(np.arange(n_los, dtype=np.int32), n_cells)
+        self.det_d = {key: np.array([det_d[key] for _, det_d in out]) for key in out[0][1].keys()}
+
+        if Rz_domain is not None:
+            R_m = np.hypot(self.cell.x, self.cell.y)
+            domain = Path(np.column_stack(Rz_domain))
+            inside = domain.contains_points(np.column_stack((R_m, self.cell.z)))
+            for key in cell_keys + ('los_index', ):
+                self.cell.__dict__[key] = self.cell.__dict__[key][inside]
+        logger.info('Done %d LOS, %d cells', n_los, len(self.cell.vol))
+
+
+    def writeLOS(self, label):
+
+        los_file = 'los/%s.h5' %label
+        cell_d = {key: self.cell.__dict__[key] for key in cell_keys + ('los_index', )}
+        write_hdf5(los_file, cell_d, self.geo, self.det_d)
@@ -203,8 +203,8 @@ class NEREUS(QMainWindow):
 #--------
 
         entries = ['TRANSP plasma', 'TRANSP fast ions', 'ASCOT file', 'Detector LoS', '#MonteCarlo', 'Response file', 'Output file']
-        combos = {'Code': ['TRANSP', 'ASCOT'], 'Spectrum': ['Total', 'Line-of-sight']}
-        cb = ['Store spectra', 'MultiProcess'] 
+        combos = {'Code': ['TRANSP', 'ASCOT', 'ANALYTIC'], 'Spectrum': ['Total', 'Line-of-sight']}
+        cb = ['Store spectra', 'MultiProcess', 'Analytic TH']
         self.fill_layout(spec_layout, 'spectrum', entries=entries, combos=combos, checkbuts=cb, ent_wid=360)
 
 #---------
@@ -214,7 +214,8 @@ class NEREUS(QMainWindow):
         entries = ['disk_thick', 'cell_radius', 'coll_diam', 'd_det_coll', 'det_radius', 'tilt',
             'tan_radius', 'y_det', 'z_det', 'Rmaj', 'r_chamb', 'label']
         cb = ['Write LOS']
-        self.fill_layout(los_layout, 'detector', entries=entries, checkbuts=cb)
+        combos = {'LOS format': ['HDF5', 'ASCII'], 'solid_angle': ['exact', 'cone']}
+        self.fill_layout(los_layout, 'detector', entries=entries, checkbuts=cb, combos=combos)
 
 #---------
 # NRESP
@@ -474,6 +475,9 @@ class NEREUS(QMainWindow):
         elif code == 'ASCOT':
             f1 = nes_d['ASCOT file']
             f2 = nes_d['ASCOT file']
+        else:
+            f1 = None
+            f2 = None
         if nes_d['Spectrum'] == 'Total':
             nes = nspectrum.nSpectrum(f1, f2, src=code.lower(), samples_per_volume_element=n_samples)
         elif nes_d['Spectrum'] == 'Line-of-sight':
@@ -489,7 +493,7 @@ class NEREUS(QMainWindow):
                         reComp = True
                         break
         if reComp:
-            nes.run(parallel=nes_d['MultiProcess'])
+            nes.run(parallel=nes_d['MultiProcess'], th_analytic=nes_d['Analytic TH'])
         else:
             nes = self.nes
         logger.info('Convolving into Pulse Height Spectrum')
@@ -524,7 +528,7 @@ class NEREUS(QMainWindow):
 
 # Write output file
         if geo['Write LOS']:
-            dlos.writeLOS()
+            dlos.writeLOS(fmt=geo['LOS format'])
 
 
     def nresp(self):
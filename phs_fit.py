@@ -0,0 +1,223 @@
+import logging
+from itertools import combinations
+import numpy as np
+from scipy.optimize import nnls
+from reactivities import brysk
+
+fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s | %(message)s', '%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('phs_fit')
+logger.setLevel(level=logging.DEBUG)
+hnd  = logging.StreamHandler()
+hnd.setLevel(level=logging.INFO)
+hnd.setFormatter(fmt)
+logger.addHandler(hnd)
+logger.propagate = False
+
+flt = np.float64
+
+
+def batch_nnls(G, b, yy, max_enum=6):
+    '''Non-negative least squares for many small problems at once.
+G: (n_spec, k, k) normal matrices, b: (n_spec, k) projections, yy: (n_spec,) weighted data norms.
+For k <= max_enum all 2^k - 1 passive sets are solved in batch and the best feasible one is kept,
+which is the exact NNLS solution; otherwise scipy's nnls is called per spectrum'''
+
+    n_spec, k = b.shape
+    amp  = np.zeros((n_spec, k), dtype=flt)
+    chi2 = yy.copy()
+
+    if k > max_enum:
+        for js in range(n_spec):
+            L = np.linalg.cholesky(G[js] + 1e-12*np.trace(G[js])*np.eye(k))
+            amp[js] = nnls(L.T, np.linalg.solve(L, b[js]))[0]
+        chi2 = yy - 2.*np.sum(amp*b, axis=1) + np.einsum('si,sij,sj->s', amp, G, amp)
+        return amp, chi2
+
+    for n_pass in range(1, k + 1):
+        for pas in combinations(range(k), n_pass):
+            pas = list(pas)
+            Gp = G[:, pas][:, :, pas]
+            bp = b[:, pas]
+            try:
+                ap = np.linalg.solve(Gp, bp[..., None])[..., 0]
+            except np.linalg.LinAlgError:
+                ap = np.einsum('sij,sj->si', np.linalg.pinv(Gp), bp)
+            chi_p = yy - np.sum(ap*bp, axis=1)
+            better = np.all(ap >= 0, axis=1) & (chi_p < chi2)
+            chi2[better] = chi_p[better]
+            amp[better] = 0.
+            amp[np.ix_(better, pas)] = ap[better]
+
+    return amp, chi2
+
+
+class PHSFIT:
+    '''Fit of measured Pulse Height Spectra with fixed neutron-spectrum components folded through a response matrix.
+Optionally a thermonuclear (Brysk) component with free Ti, using a precomputed basis over a Ti grid'''
+
+
+    def __init__(self, resp, En_keV, comp_d={}, Ti_keV=None, reac_lbl='D(D,n)3He', phs_lim=None, kind='nearest'):
+
+        self.En_keV = np.asarray(En_keV, dtype=flt)
+        self.jphs = np.ones(len(resp.Ephs_MeVee), dtype=bool)
+        if phs_lim is not None:
+            self.jphs = (resp.Ephs_MeVee >= phs_lim[0]) & (resp.Ephs_MeVee <= phs_lim[1])
+        self.Ephs_MeVee = resp.Ephs_MeVee[self.jphs]
+
+# Folded component shapes = Jacobian w.r.t. the amplitudes
+
+        self.labels = list(comp_d.keys())
+        if self.labels:
+            comps = np.vstack([comp_d[lbl] for lbl in self.labels])
+            self.shapes = resp.fold(1e-3*self.En_keV, comps, kind=kind)[:, self.jphs]
+        else:
+            self.shapes = np.zeros((0, np.sum(self.jphs)), dtype=flt)
+
+# Thermonuclear basis on a Ti grid, with its Ti derivative
+
+        self.Ti_keV = None
+        if Ti_keV is not None:
+            self.Ti_keV = np.asarray(Ti_keV, dtype=flt)
+            th_nes = np.atleast_2d(brysk(self.En_keV, self.Ti_keV, reac_lbl=reac_lbl))
+            self.th_shapes = resp.fold(1e-3*self.En_keV, th_nes, kind=kind)[:, self.jphs]
+            self.th_dshapes = np.gradient(self.th_shapes, self.Ti_keV, axis=0)
+            logger.info('Thermonuclear basis with %d Ti values', len(self.Ti_keV))
+
+
+    def select(self, phs):
+
+        phs = np.atleast_2d(np.asarray(phs, dtype=flt))
+        if phs.shape[1] != len(self.Ephs_MeVee):
+            phs = phs[:, self.jphs]
+        return phs
+
+
+    def solve(self, B, phs, wgt):
+        '''Batched NNLS of phs against the shapes B (k, n_phs) or (n_spec, k, n_phs)'''
+
+        if B.ndim == 2:
+            G = np.einsum('ij,sj,kj->sik', B, wgt, B, optimize=True)
+            b = np.einsum('ij,sj->si', B, wgt*phs)
+        else:
+            G = np.einsum('sij,sj,skj->sik', B, wgt, B, optimize=True)
+            b = np.einsum('sij,sj->si', B, wgt*phs)
+        yy = np.sum(wgt*phs**2, axis=1)
+
+        return batch_nnls(G, b, yy)
+
+
+    def fit(self, phs, sigma=None, n_reweight=2):
+        '''Fit a stack of PHS (n_spec, n_phs). sigma defaults to Poisson errors, taken from the fitted model
+after the first pass (n_reweight passes) to avoid the low-count bias of data-based weights.
+Returns a dict with amplitudes, Ti (if a Ti grid is set), their uncertainties and chi2/dof'''
+
+        phs = self.select(phs)
+        n_spec, n_phs = phs.shape
+        if sigma is None:
+            wgt = 1./np.maximum(phs, 1.)
+        else:
+            wgt = np.broadcast_to(1./np.maximum(self.select(sigma)**2, 1e-30), phs.shape)
+            n_reweight = 0
+
+        for jfit in range(n_reweight + 1):
+            if jfit > 0:
+                wgt = 1./np.maximum(np.einsum('si,sij->sj', amp, jac[:, :amp.shape[1]]), 1.)
+            out, amp, chi2, jac = self.fit_weighted(phs, wgt)
+
+        return self.errors(out, amp, chi2, jac, wgt)
+
+
+    def fit_weighted(self, phs, wgt):
+
+        n_spec, n_phs = phs.shape
+        out = {}
+
+        if self.Ti_keV is None:
+            amp, chi2 = self.solve(self.shapes, phs, wgt)
+            jac = np.broadcast_to(self.shapes, (n_spec, ) + self.shapes.shape)
+        else:
+# Scan of the Ti basis, then parabolic refinement around the best node
+            nT = len(self.Ti_keV)
+            chi_scan = np.zeros((n_spec, nT), dtype=flt)
+            for jT in range(nT):
+                B = np.vstack((self.th_shapes[jT], self.shapes))
+                chi_scan[:, jT] = self.solve(B, phs, wgt)[1]
+            jbest = np.clip(np.argmin(chi_scan, axis=1), 1, nT - 2)
+            ind = np.vstack((jbest - 1, jbest, jbest + 1))
+            x = self.Ti_keV[ind]
+            y = chi_scan[np.arange(n_spec), ind]
+            den = (x[0] - x[1])*(x[0] - x[2])*(x[1] - x[2])
+            pa = (x[2]*(y[1] - y[0]) + x[1]*(y[0] - y[2]) + x[0]*(y[2] - y[1]))/den
+            pb = (x[2]**2*(y[0] - y[1]) + x[1]**2*(y[2] - y[0]) + x[0]**2*(y[1] - y[2]))/den
+            Ti = np.where(pa > 0, -0.5*pb/np.where(pa > 0, pa, 1.), x[1])
+            Ti = np.clip(Ti, x[0], x[2])
+            out['Ti'] = Ti
+
+            jT = np.clip(np.searchsorted(self.Ti_keV, Ti) - 1, 0, nT - 2)
+            wT = ((Ti - self.Ti_keV[jT])/(self.Ti_keV[jT + 1] - self.Ti_keV[jT]))[:, None]
+            th_shape  = (1. - wT)*self.th_shapes [jT] + wT*self.th_shapes [jT + 1]
+            th_dshape = (1. - wT)*self.th_dshapes[jT] + wT*self.th_dshapes[jT + 1]
+            B = np.concatenate((th_shape[:, None, :], np.broadcast_to(self.shapes, (n_spec, ) + self.shapes.shape)), axis=1)
+            amp, chi2 = self.solve(B, phs, wgt)
+            jac = np.concatenate((B, (amp[:, 0, None]*th_dshape)[:, None, :]), axis=1)
+
+        return out, amp, chi2, jac
+
+
+    def errors(self, out, amp, chi2, jac, wgt):
+
+        n_phs = jac.shape[2]
+# Covariance from the cached Jacobians
+        hess = np.einsum('sij,sj,skj->sik', jac, wgt, jac, optimize=True)
+        npar = hess.shape[1]
+        cov = np.linalg.pinv(hess + 1e-30*np.eye(npar))
+        err = np.sqrt(np.maximum(np.diagonal(cov, axis1=1, axis2=2), 0.))
+        dof = max(n_phs - npar, 1)
+
+        labels = self.labels if self.Ti_keV is None else ['th'] + self.labels
+        for jlbl, lbl in enumerate(labels):
+            out[lbl] = amp[:, jlbl]
+            out['%s_err' %lbl] = err[:, jlbl]
+        if self.Ti_keV is not None:
+            out['Ti_err'] = err[:, -1]
+        out['chi2'] = chi2/dof
+
+        return out
+
+
+def from_nspectrum(resp, nes, reacs=('th', 'bt', 'bb'), **kwargs):
+    '''PHSFIT with the DRESS components of an nSpectrum object, each normalised to unit rate'''
+
+    bin_keV = nes.En[1] - nes.En[0]
+    comp_d = {}
+    for reac in reacs:
+        spec = nes.__dict__[reac]
+        comp_d[reac] = spec/(bin_keV*np.sum(spec))
+
+    return PHSFIT(resp, nes.En, comp_d=comp_d, **kwargs)
+
+
+if __name__ == "__main__":
+
+    import time
+    import response
+
+# Fit 5000 synthetic time slices: free-Ti thermonuclear + fixed beam-target shape
+
+    rsp = response.RESP()
+    rsp.from_cdf('%s/rm_gb.cdf' %response.responseDir)
+    En_keV = np.arange(1505., 3500., 10.)
+    bt = brysk(En_keV, 40.) # broad stand-in for a beam-target shape
+    fit = PHSFIT(rsp, En_keV, comp_d={'bt': bt}, Ti_keV=np.linspace(1., 20., 39), phs_lim=(0.05, 2.))
+
+    n_spec = 5000
+    rng = np.random.default_rng(0)
+    Ti_true = rng.uniform(3., 15., n_spec)
+    nes = 1e5*brysk(En_keV, Ti_true) + 3e5*bt[None, :]
+    phs_meas = rng.poisson(np.maximum(rsp.fold(1e-3*En_keV, nes)[:, fit.jphs], 0.)).astype(flt)
+
+    t0 = time.time()
+    res = fit.fit(phs_meas)
+    dt = time.time() - t0
+    logger.info('%d spectra in %6.3f s, mean chi2/dof %6.3f', n_spec, dt, np.mean(res['chi2']))
+    logger.info('Ti bias %8.3f keV, rms %8.3f keV, mean Ti_err %8.3f keV', np.mean(res['Ti'] - Ti_true), np.std(res['Ti'] - Ti_true), np.mean(res['Ti_err']))
@@ -0,0 +1,128 @@
+import numpy as np
+from reactions import reaction, deuteron, triton, he3, proton
+from reactivities import react_multi, react_labels, REACT_TABLE
+
+# Density label of each reactant in the dens_d input dictionaries
+species_lbl = {deuteron: 'D', triton: 'T', he3: '3He', proton: 'H'}
+
+
+class RATES:
+    '''Volume-integrated thermonuclear reaction rates (1/s) from Ti and density profiles on a rho grid.
+The volumes (e.g. code_d cells or LoS cells) enter once, as quadrature weights on the rho nodes:
+rate = sum_j n1*n2/(1 + delta_12)*<sigma v>(Ti)[j]*W[j], W = sum of the linear-interpolation weights
+of each volume times dV (times omega/4pi for LoS cells). Batches of profiles are evaluated at once'''
+
+
+    def __init__(self, rho_grid, rho_vol, dV, solid_angle=None, reac_lbls=react_labels, rtol=None):
+
+        self.rho = np.asarray(rho_grid, dtype=np.float64)
+        self.reac_lbls = tuple(reac_lbls)
+        rho_vol = np.asarray(rho_vol, dtype=np.float64)
+        wgt = np.asarray(dV, dtype=np.float64)
+        if solid_angle is not None:
+            wgt = wgt*solid_angle/(4.*np.pi)
+        inside = np.isfinite(rho_vol) & (rho_vol <= self.rho[-1])
+        x = np.interp(rho_vol[inside], self.rho, np.arange(len(self.rho)))
+        j = np.minimum(x.astype(np.int64), len(self.rho) - 2)
+        w = x - j
+        n_rho = len(self.rho)
+        self.W = np.bincount(j, weights=(1. - w)*wgt[inside], minlength=n_rho) \
+               + np.bincount(j + 1, weights=w*wgt[inside], minlength=n_rho)
+        self.volume = np.sum(wgt[inside])
+        self.table = None if rtol is None else REACT_TABLE(self.reac_lbls, rtol=rtol)
+
+
+    @classmethod
+    def from_code_d(cls, code_d, rho_grid=None, **kwargs):
+        '''Quadrature weights from the cells of a fi_codes code_d (or a LoS-mapped nSpectrum.dressInput)'''
+
+        rho_grid = np.linspace(0., 1., 101) if rho_grid is None else rho_grid
+        return cls(rho_grid, code_d['rho'], code_d['dV'], solid_angle=code_d.get('solidAngle'), **kwargs)
+
+
+    def sigmav(self, Ti_keV):
+        '''Reactivities (m**3/s), (n_reac, *Ti_keV.shape)'''
+
+        Ti_keV = np.maximum(Ti_keV, 1e-3)
+        if self.table is None:
+            return 1e-6*react_multi(Ti_keV, self.reac_lbls)
+        return 1e-6*self.table(Ti_keV)
+
+
+    def __call__(self, Ti_keV, dens_d):
+        '''Rates of all reactions. Ti_keV: (n_rho,) or (n_prof, n_rho) in keV;
+dens_d: {'D': nD, 'T': nT, '3He': n3He, 'H': nH} in 1/m**3, same shape as Ti_keV; missing species count as zero.
+Returns {reac_lbl: rate} with rate of shape () or (n_prof, )'''
+
+        Ti_keV = np.asarray(Ti_keV, dtype=np.float64)
+        sigv = self.sigmav(Ti_keV)
+        rate_d = {}
+        for jreac, lbl in enumerate(self.reac_lbls):
+            reac = reaction[lbl]
+            lbl1 = species_lbl[reac.in1]
+            lbl2 = species_lbl[reac.in2]
+            if lbl1 not in dens_d or lbl2 not in dens_d:
+                rate_d[lbl] = np.zeros(Ti_keV.shape[:-1])
+                continue
+            nn = dens_d[lbl1]*dens_d[lbl2]
+            if lbl1 == lbl2: # identical reactants
+                nn = 0.5*nn
+            rate_d[lbl] = (nn*sigv[jreac]) @ self.W
+        return rate_d
+
+
+def cell_rates(code_d, dens_d=None, reac_lbls=react_labels):
+    '''Rates (1/s) summed directly over the cells of a code_d, using its Ti and nd (and solidAngle for LoS cells);
+dens_d can add other species per cell, e.g. {'T': nT}'''
+
+    dens = {'D': np.nan_to_num(code_d['nd'])}
+    if dens_d is not None:
+        dens.update(dens_d)
+    wgt = code_d['dV'] if 'solidAngle' not in code_d else code_d['dV']*code_d['solidAngle']/(4.*np.pi)
+    Ti = np.nan_to_num(code_d['Ti'])
+    sigv = 1e-6*react_multi(np.maximum(Ti, 1e-3), reac_lbls)
+    rate_d = {}
+    for jreac, lbl in enumerate(reac_lbls):
+        reac = reaction[lbl]
+        lbl1 = species_lbl[reac.in1]
+        lbl2 = species_lbl[reac.in2]
+        if lbl1 not in dens or lbl2 not in dens:
+            rate_d[lbl] = 0.
+            continue
+        nn = dens[lbl1]*dens[lbl2]*(0.5 if lbl1 == lbl2 else 1.)
+        rate_d[lbl] = np.sum(np.where(Ti > 0, nn*sigv[jreac], 0.)*wgt)
+    return rate_d
+
+
+if __name__ == "__main__":
+
+    import time
+
+# Profile scan: 10000 random parabolic profiles on a 101-point rho grid, 20000 plasma cells
+
+    rng = np.random.default_rng(0)
+    n_vol = 20000
+    rho_vol = np.sqrt(rng.random(n_vol))
+    dV = np.full(n_vol, 14./n_vol) # m**3
+    rho = np.linspace(0., 1., 101)
+    rates = RATES(rho, rho_vol, dV)
+    rates_tab = RATES(rho, rho_vol, dV, rtol=1e-6)
+
+    n_prof = 10000
+    Ti0 = rng.uniform(2., 20., n_prof)[:, None]
+    n0  = rng.uniform(2e19, 1e20, n_prof)[:, None]
+    Ti = Ti0*(1. - 0.9*rho**2)
+    nD = n0*(1. - 0.7*rho**2)
+    dens_d = {'D': 0.5*nD, 'T': 0.5*nD, '3He': 0.01*nD}
+
+    for lbl, rts in (('exact', rates), ('table', rates_tab)):
+        t0 = time.time()
+        res = rts(Ti, dens_d)
+        dt = time.time() - t0
+        print('%s: %d profiles in %6.3f s, %10.1f profiles/s' %(lbl, n_prof, dt, n_prof/dt))
+
+# Check against direct summation over the cells for the first profile
+    code_d = {'rho': rho_vol, 'dV': dV, 'Ti': np.interp(rho_vol, rho, Ti[0]), 'nd': np.interp(rho_vol, rho, 0.5*nD[0])}
+    direct = cell_rates(code_d, dens_d={'T': np.interp(rho_vol, rho, 0.5*nD[0]), '3He': np.interp(rho_vol, rho, 0.01*nD[0])})
+    for lbl in react_labels:
+        print('%-12s %12.4e 1/s, quadrature/direct - 1 = %9.2e' %(lbl, res[lbl][0], res[lbl][0]/direct[lbl] - 1.))
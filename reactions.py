@@ -41,7 +41,7 @@ reaction['D(D,n)3He'].in1 = deuteron
 reaction['D(D,n)3He'].in2 = deuteron
 reaction['D(D,n)3He'].prod1 = neutron
 reaction['D(D,n)3He'].prod2 = he3
-reaction['D(D,n)3He'].coeff_reac = [5.4336e-12, 5.85778e-3, 7.68222-3, 0, -2.964e-6, 0, 0]
+reaction['D(D,n)3He'].coeff_reac = [5.4336e-12, 5.85778e-3, 7.68222e-3, 0, -2.964e-6, 0, 0]
 
 reaction['D(D,P)T'] = reac_class()
 reaction['D(D,P)T'].in1 = deuteron
@@ -1,6 +1,7 @@
 import numpy as np
+from scipy.special import erf
 from reactions import reaction
-from constants import alpha
+from constants import alpha, c
 
 # ControlRoom/source/reactivities.cpp
 #
@@ -13,18 +14,40 @@ from constants import alpha
 #   DDpt  : 0.2-100
 
 
+def reac_params(reac_lbl):
+    '''Bosch-Hale coefficients, reduced mass (keV) and Gamow constant of a reaction'''
+
+    reac = reaction[reac_lbl]
+    mu_c2 = 1e3*(reac.in1.m * reac.in2.m)/(reac.in1.m + reac.in2.m) # MeV -> keV
+    Bg = np.pi * alpha * reac.in1.Z * reac.in2.Z * np.sqrt(2 * mu_c2)
+    return tuple([float(x) for x in reac.coeff_reac]), mu_c2, Bg
+
+
+# Precompiled parameters of all reactions with Bosch-Hale coefficients: (n_reac, 7) coefficients, mu_c2, Bg
+react_labels = tuple([lbl for lbl, reac in reaction.items() if hasattr(reac, 'coeff_reac')])
+react_index = {lbl: jreac for jreac, lbl in enumerate(react_labels)}
+react_coeff, react_mu_c2, react_Bg = [np.array(par, dtype=np.float64) for par in zip(*[reac_params(lbl) for lbl in react_labels])]
+
+
 def react(T_keV, reac_lbl):
     '''Input:
         Ti: reactant temperature (scalar or 1d array) in keV
     '''
 
-# Reduced mass, MeV -> keV
+    return react_multi(T_keV, (reac_lbl, ))[0]
 
-    reac = reaction[reac_lbl]
-    coeff = reac.coeff_reac
-    mu_c2 = 1e3*(reac.in1.m * reac.in2.m)/(reac.in1.m + reac.in2.m)
 
-    Bg = np.pi * alpha * reac.in1.Z * reac.in2.Z * np.sqrt(2 * mu_c2)
+def react_multi(T_keV, reac_lbls=react_labels):
+    '''Reactivities (cm**3/s) of several reactions for a temperature array of any shape (keV),
+evaluated in one broadcasted pass over the precompiled coefficients; output (len(reac_lbls), *T_keV.shape)'''
+
+    T_keV = np.asarray(T_keV, dtype=np.float64)[None, ...]
+    jreac = [react_index[lbl] for lbl in reac_lbls]
+    shape = (len(jreac), ) + (1, )*(T_keV.ndim - 1)
+    coeff = [react_coeff[jreac, k].reshape(shape) for k in range(7)]
+    mu_c2 = react_mu_c2[jreac].reshape(shape)
+    Bg    = react_Bg[jreac].reshape(shape)
+
     theta = T_keV/(  1 - \
         (T_keV * (coeff[1] + T_keV * (coeff[3] + T_keV * coeff[5]))) / \
         (1 + T_keV * (coeff[2] + T_keV * (coeff[4] + T_keV * coeff[6])))  \
@@ -33,3 +56,89 @@ def react(T_keV, reac_lbl):
     react = coeff[0] * theta * np.sqrt(csi/(mu_c2 * T_keV**3)) * np.exp(-3*csi)
 
     return react
+
+
+class REACT_TABLE:
+    '''Lookup table of log(reactivity) on a log-spaced temperature grid, linear interpolation.
+The grid is refined until the relative error, checked on 8 points per interval, is below rtol.
+Temperatures outside T_lim are evaluated exactly'''
+
+
+    def __init__(self, reac_lbls=react_labels, T_lim=(0.2, 100.), rtol=1e-6, n_start=64):
+
+        self.reac_lbls = tuple(reac_lbls)
+        self.T_lim = T_lim
+        self.rtol = rtol
+        n_T = n_start
+        while True:
+            logT = np.linspace(np.log(T_lim[0]), np.log(T_lim[1]), n_T)
+            log_r = np.log(react_multi(np.exp(logT), self.reac_lbls))
+            logT_chk = np.linspace(logT[0], logT[-1], 8*(n_T - 1) + 1)
+            exact = react_multi(np.exp(logT_chk), self.reac_lbls)
+            approx = np.exp(np.array([np.interp(logT_chk, logT, lr) for lr in log_r]))
+            err = np.max(np.abs(approx/exact - 1.))
+            if err <= 0.5*rtol:
+                break
+            n_T = 2*n_T - 1
+        self.logT = logT
+        self.log_r = log_r
+        self.slope = np.diff(log_r, axis=1) # per interval
+        self.dlogT = logT[1] - logT[0]
+        self.err = err
+
+
+    def __call__(self, T_keV):
+        '''Reactivities (cm**3/s), (len(reac_lbls), *T_keV.shape)'''
+
+        T_keV = np.asarray(T_keV, dtype=np.float64)
+        x = (np.log(T_keV) - self.logT[0])/self.dlogT
+        inside = (T_keV >= self.T_lim[0]) & (T_keV <= self.T_lim[1])
+        j = np.clip(np.where(inside, x, 0.).astype(np.int64), 0, len(self.logT) - 2)
+        w = np.where(inside, x, 0.) - j
+        out = np.empty((len(self.reac_lbls), ) + T_keV.shape, dtype=np.float64)
+        for jreac in range(len(self.reac_lbls)):
+            out[jreac] = np.exp(self.log_r[jreac, j] + w*self.slope[jreac, j])
+        if not np.all(inside):
+            out[:, ~inside] = react_multi(T_keV[~inside], self.reac_lbls)
+        return out
+
+
+def brysk_moments(T_keV, reac_lbl='D(D,n)3He', v_proj=0.):
+    '''Mean energy and standard deviation (keV) of the Brysk neutron spectrum, (len(T_keV), 1) arrays'''
+
+    reac = reaction[reac_lbl]
+    mn = 1e3*reac.prod1.m # MeV -> keV
+    mp = 1e3*reac.prod2.m
+    Q  = 1e3*(reac.in1.m + reac.in2.m) - mn - mp
+    E0 = Q*mp/(mn + mp)
+
+    T_keV  = np.atleast_1d(T_keV)[:, None]
+    v_proj = np.atleast_1d(v_proj)[:, None]
+    Emean = E0 + np.sqrt(2.*mn*E0)*v_proj/c
+    sigma = np.sqrt(2.*mn*E0*T_keV/(mn + mp))
+
+    return Emean, sigma
+
+
+def brysk(En_keV, T_keV, reac_lbl='D(D,n)3He', v_proj=0.):
+    '''Gaussian neutron spectrum (normalised, 1/keV) of a Maxwellian plasma [Brysk 1973]
+Input:
+    En_keV: neutron energy grid (1d array) in keV
+    T_keV : ion temperature (scalar or 1d array) in keV
+    v_proj: projection of the plasma velocity on the line of sight (scalar or 1d array) in m/s
+Output: (len(T_keV), len(En_keV)) array, squeezed'''
+
+    Emean, sigma = brysk_moments(T_keV, reac_lbl=reac_lbl, v_proj=v_proj)
+    spec = np.exp(-0.5*((En_keV[None, :] - Emean)/sigma)**2)/(np.sqrt(2.*np.pi)*sigma)
+
+    return np.squeeze(spec)
+
+
+def brysk_bins(En_bins, T_keV, reac_lbl='D(D,n)3He', v_proj=0.):
+    '''Brysk spectrum integrated over the energy bins with edges En_bins (keV): fraction of neutrons per bin.
+Output: (len(T_keV), len(En_bins)-1) array'''
+
+    Emean, sigma = brysk_moments(T_keV, reac_lbl=reac_lbl, v_proj=v_proj)
+    cdf = 0.5*erf((En_bins[None, :] - Emean)/(np.sqrt(2.)*sigma))
+
+    return np.diff(cdf, axis=1)
@@ -1,7 +1,8 @@
-import os, sys, datetime, logging
+import os, sys, datetime, logging, hashlib
 import numpy as np
 import rw_for
 from scipy.io import netcdf_file
+from scipy.sparse import csr_matrix
 
 fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s | %(message)s', '%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger('resp')
@@ -17,6 +18,13 @@ responseDir = '%s/responses' %nereusDir
 out_dir = '%s/output' %nereusDir
 os.system('mkdir -p %s' %out_dir)
 
+# Broadening kernels, keyed by (a, b, c, Ec_fac, Ebin, PHS bin edges)
+kernel_cache = {}
+# Energy-grid interpolation operators, keyed by (input grid, output grid, kind)
+interp_cache = {}
+# Resolution parameters, keyed by (realpath, mtime) of the neut_fit file
+broadening_cache = {}
+
 
 def gauss_kernel(Emid, sigma, Ec_sim):
 
@@ -30,6 +38,105 @@ def gauss_kernel(Emid, sigma, Ec_sim):
     return gau_kernel
 
 
+def read_broadening(f_par='%s/neut_fit.txt' %responseDir):
+    '''Read the resolution parameters a, b, c, z, Ec_fac from a neut_fit file, parsed once per file version'''
+
+    key = (os.path.realpath(f_par), os.stat(f_par).st_mtime_ns)
+    if key in broadening_cache:
+        return broadening_cache[key]
+
+    with open(f_par, 'r') as f:
+        lin = f.readlines()[13].split()
+    a, b, c, z, Ec_fac = [float(x) for x in lin[3:8]]
+    logger.debug('%8.4f %8.4f %8.4f %8.4f %8.4f', a, b, c, z, Ec_fac)
+    broadening_cache[key] = (a, b, c, z, Ec_fac)
+
+    return a, b, c, z, Ec_fac
+
+
+def broadening_kernel(EphsB_MeVee, Ebin_MeVee, a, b, c, Ec_fac, cache_dir=None):
+    '''Gaussian broadening kernel on a PHS grid, cached in memory and optionally on disk (cache_dir)'''
+
+    EphsB = np.asarray(EphsB_MeVee, dtype=np.float64)
+    Ebin  = float(np.atleast_1d(Ebin_MeVee)[0])
+    sha = hashlib.sha1(EphsB.tobytes())
+    sha.update(np.array([a, b, c, Ec_fac, Ebin]).tobytes())
+    key = sha.hexdigest()
+
+    if key in kernel_cache:
+        return kernel_cache[key]
+
+    f_ker = None
+    if cache_dir is not None:
+        f_ker = '%s/gauss_kernel_%s.npy' %(cache_dir, key)
+        if os.path.isfile(f_ker):
+            logger.info('Reading Gaussian kernel from %s', f_ker)
+            kernel_cache[key] = np.load(f_ker)
+            return kernel_cache[key]
+
+    Emid = 0.5*(EphsB[1:] + EphsB[:-1])
+    sigma = np.sqrt(a**2 * Emid**2 + b**2 * Emid + c**2)/235.48
+    gau_ker = gauss_kernel(Emid, sigma, Ebin)
+    kernel_cache[key] = gau_ker
+
+    if f_ker is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(f_ker, gau_ker)
+        logger.info('Stored Gaussian kernel %s', f_ker)
+
+    return gau_ker
+
+
+def broaden_many(RespMats, gau_ker):
+    '''Apply one prepared broadening kernel to a list/stack of response matrices (n_En, n_phs)'''
+
+    if isinstance(RespMats, np.ndarray) and RespMats.ndim == 2:
+        return np.matmul(RespMats, gau_ker)
+    stack = np.vstack(RespMats)
+    out = np.matmul(stack, gau_ker)
+    jsplit = np.cumsum([len(rm) for rm in RespMats])[:-1]
+
+    return np.split(out, jsplit, axis=0)
+
+
+def interp_operator(E_in, E_out, kind='nearest'):
+    '''Sparse matrix (len(E_in), len(E_out)) mapping values on E_in onto the nodes E_out.
+kind='nearest': each E_in contributes to the closest E_out
+kind='linear' : each E_in is shared linearly between the bracketing E_out'''
+
+    E_in  = np.asarray(E_in , dtype=np.float64)
+    E_out = np.asarray(E_out, dtype=np.float64)
+    sha = hashlib.sha1(E_in.tobytes())
+    sha.update(E_out.tobytes())
+    sha.update(kind.encode())
+    key = sha.hexdigest()
+    if key in interp_cache:
+        return interp_cache[key]
+
+    n_in  = len(E_in)
+    n_out = len(E_out)
+    rows = np.arange(n_in)
+    if kind == 'nearest':
+        cols = np.argmin(np.abs(E_in[:, None] - E_out[None, :]), axis=1)
+        wgt = np.ones(n_in)
+    elif kind == 'linear':
+        if np.any(np.diff(E_out) <= 0):
+            raise ValueError('Output energy grid must be strictly increasing for linear interpolation')
+        E_clip = np.clip(E_in, E_out[0], E_out[-1])
+        jright = np.clip(np.searchsorted(E_out, E_clip), 1, n_out - 1)
+        jleft = jright - 1
+        w_right = (E_clip - E_out[jleft])/(E_out[jright] - E_out[jleft])
+        rows = np.append(rows, rows)
+        cols = np.append(jleft, jright)
+        wgt  = np.append(1. - w_right, w_right)
+    else:
+        raise ValueError('Unknown interpolation kind "%s"' %kind)
+
+    interp_cache[key] = csr_matrix((wgt, (rows, cols)), shape=(n_in, n_out))
+
+    return interp_cache[key]
+
+
 class RESP:
 
 
@@ -164,27 +271,37 @@ class RESP:
         self.Ephs_MeVee = 0.5*(self.EphsB_MeVee[1:] + self.EphsB_MeVee[:-1])
 
 
-    def broaden(self, f_par='%s/neut_fit.txt' %responseDir):
+    def broaden(self, f_par='%s/neut_fit.txt' %responseDir, cache_dir=None):
         '''Gaussian broadening of the response function'''
 
 # Broadening parameters
 
         logger.info('Gaussian convolution')
-        f = open(f_par, 'r')
-        lin = f.readlines()[13].split()
-        a = float(lin[3])
-        b = float(lin[4])
-        c = float(lin[5])
-        z = float(lin[6])
-        Ec_fac = float(lin[7])
-        logger.debug('%8.4f %8.4f %8.4f %8.4 %8.4f', a, b, c, z, Ec_fac)
-
-        Emid = self.Ephs_MeVee
-        sigma = np.sqrt(a**2 * Emid**2 + b**2 * Emid + c**2)/235.48
+        a, b, c, z, Ec_fac = read_broadening(f_par)
 
         logger.info('Gaussian kernel from file %s', f_par)
-        gau_ker = gauss_kernel(self.Ephs_MeVee, sigma, self.Ebin_MeVee)
-        self.RespMat_gb = np.einsum('ij,jk->ik', self.RespMat, gau_ker)
+        gau_ker = broadening_kernel(self.EphsB_MeVee, self.Ebin_MeVee, a, b, c, Ec_fac, cache_dir=cache_dir)
+        self.RespMat_gb = broaden_many(self.RespMat, gau_ker)
+
+
+    def fold(self, En_MeV, spectra, kind='nearest', dtype=np.float64):
+        '''Fold a stack of neutron spectra (n_spec, n_En), given on the grid En_MeV, into Pulse Height Spectra (n_spec, n_phs).
+The rebinning operator onto self.En_MeV is cached; dtype=np.float32 halves the memory traffic'''
+
+        spectra = np.atleast_2d(np.asarray(spectra, dtype=dtype))
+        interp_op = interp_operator(En_MeV, self.En_MeV, kind=kind)
+
+# Keep one copy of the response matrix per dtype, refreshed if RespMat is replaced
+        if not hasattr(self, 'RespMat_typ') or self.RespMat_typ[0] is not self.RespMat:
+            self.RespMat_typ = (self.RespMat, {})
+        rm_d = self.RespMat_typ[1]
+        key = np.dtype(dtype).str
+        if key not in rm_d:
+            rm_d[key] = np.ascontiguousarray(self.RespMat, dtype=dtype)
+
+        spc_resp = np.asarray((interp_op.T @ spectra.T).T, dtype=dtype) # n_spec, n_En_resp
+
+        return np.matmul(spc_resp, rm_d[key])
 
 
     def to_hepro(self, fout='%s/ddnpar.asc' %responseDir):